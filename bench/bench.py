@@ -0,0 +1,184 @@
+#!/usr/bin/python
+
+"""
+Measures the time that mabigat itself adds to every trial. A study of fake engines is run
+end-to-end without network or real engines, the fake engine and the fake cutechess reply
+at once, so the time of every stage is the overhead of mabigat: engine starts and
+handshakes, file moves, plots and the storage. Example:
+
+python bench/bench.py --trials 20 --workers 2 --json bench_results.jsonl
+
+The study is run in a temp folder with a copy of mabigat.py, match.py and binpack_tool.py
+of this tree. The fake engine and cutechess are scripts, they need an OS that runs them
+from their shebang line.
+"""
+
+
+import sys
+import os
+import argparse
+import configparser
+import csv
+import json
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+
+BENCH_FOLDER = Path(__file__).resolve().parent
+REPO_FOLDER = BENCH_FOLDER.parent
+SCRIPTS = ['mabigat.py', 'match.py', 'binpack_tool.py']
+STUDY_NAME = 'bench'
+
+
+def write_ini(fn, args):
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read(BENCH_FOLDER / 'bench.ini')
+
+    parser['MABIGAT']['workers'] = str(args.workers)
+    parser['MABIGAT']['pipeline'] = str(args.pipeline)
+    parser['OPTUNA']['study_name'] = STUDY_NAME
+    parser['OPTUNA']['num_trials'] = str(args.trials)
+    parser['ENGINE']['engine_file'] = (BENCH_FOLDER / 'fake_engine.py').as_posix()
+    parser['CUTECHESS']['python_file'] = Path(sys.executable).as_posix()
+    parser['CUTECHESS']['cutechess_cli_path'] = (BENCH_FOLDER / 'fake_cutechess.py').as_posix()
+
+    with open(fn, 'w') as f:
+        parser.write(f)
+
+
+def read_trials(fn):
+    """
+    Returns the rows of the trial log of the study.
+    """
+    with open(fn, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def get_stage_times(rows):
+    """
+    Returns {stage: [seconds, ...]} of the time_* columns and of the time of a trial that
+    is not in any stage.
+    """
+    stages = [c for c in rows[0] if c.startswith('time_')] if rows else []
+    times = {stage: [] for stage in stages + ['other']}
+    for row in rows:
+        total = 0.0
+        for stage in stages:
+            if row[stage] != '':
+                times[stage].append(float(row[stage]))
+                total += float(row[stage])
+        if row['duration'] != '':
+            times['other'].append(max(0.0, float(row['duration']) - total))
+    return times
+
+
+def count_events(fn):
+    """
+    Returns the number of engine starts and commands of the fake engine.
+    """
+    if not fn.is_file():
+        return Counter()
+    with open(fn) as f:
+        return Counter(line.split()[1] for line in f if line.strip())
+
+
+def summary(values):
+    if not values:
+        return {'mean': None, 'median': None, 'max': None}
+    return {'mean': round(statistics.mean(values), 3),
+            'median': round(statistics.median(values), 3),
+            'max': round(max(values), 3)}
+
+
+def run(args):
+    work = Path(tempfile.mkdtemp(prefix='mabigat_bench_'))
+    try:
+        for script in SCRIPTS:
+            shutil.copy(REPO_FOLDER / script, work / script)
+        write_ini(work / 'bench.ini', args)
+
+        events_fn = work / 'engine_events.txt'
+        env = dict(os.environ, MABIGAT_BENCH_EVENTS=str(events_fn))
+
+        start = time.perf_counter()
+        with open(work / 'bench_output.txt', 'w') as output:
+            process = subprocess.run([sys.executable, 'mabigat.py', '--ini-file', 'bench.ini'],
+                                     cwd=work, env=env, stdout=output, stderr=subprocess.STDOUT)
+        wall = time.perf_counter() - start
+
+        if process.returncode != 0:
+            with open(work / 'bench_output.txt') as f:
+                sys.stderr.write(f.read()[-4000:])
+            raise RuntimeError(f'mabigat exited with {process.returncode}, see {work}')
+
+        rows = read_trials(work / 'study' / STUDY_NAME / f'{STUDY_NAME}.csv')
+        events = count_events(events_fn)
+    finally:
+        if args.keep:
+            print(f'study folder: {work}')
+        else:
+            shutil.rmtree(work, ignore_errors=True)
+
+    states = Counter(row['state'] for row in rows)
+    num = max(1, len(rows))
+    return {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'trials': len(rows),
+        'workers': args.workers,
+        'pipeline': args.pipeline,
+        'states': dict(states),
+        'wall_s': round(wall, 3),
+        'wall_per_trial_s': round(wall / num, 3),
+        'stages_s': {stage: summary(values) for stage, values in get_stage_times(rows).items()},
+        'engine_starts_per_trial': round(events['start'] / num, 2),
+        'handshakes_per_trial': round(events['uci'] / num, 2),
+        'isready_per_trial': round(events['isready'] / num, 2)
+    }
+
+
+def print_result(result):
+    print(f'trials: {result["trials"]}, workers: {result["workers"]}, pipeline: {result["pipeline"]}, states: {result["states"]}')
+    print(f'wall: {result["wall_s"]}s, per trial: {result["wall_per_trial_s"]}s')
+    print(f'engine starts per trial: {result["engine_starts_per_trial"]}, '
+          f'uci handshakes per trial: {result["handshakes_per_trial"]}, '
+          f'isready per trial: {result["isready_per_trial"]}')
+    print(f'{"stage":<16}{"mean":>10}{"median":>10}{"max":>10}')
+    for stage, s in result['stages_s'].items():
+        values = ['-' if s[k] is None else f'{s[k]:0.3f}' for k in ['mean', 'median', 'max']]
+        print(f'{stage:<16}{values[0]:>10}{values[1]:>10}{values[2]:>10}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measure the overhead of mabigat per trial with a fake engine and cutechess.')
+    parser.add_argument('--trials', type=int, default=10, help='The number of trials, default=10.')
+    parser.add_argument('--workers', type=int, default=1, help='The number of workers, default=1.')
+    parser.add_argument('--pipeline', type=int, default=0, choices=[0, 1],
+                        help='Overlap the stages of consecutive trials, default=0.')
+    parser.add_argument('--json', help='Append the result as a json line to this file.')
+    parser.add_argument('--keep', action='store_true', help='Keep the temp folder of the study.')
+
+    args = parser.parse_args(argv)
+
+    try:
+        result = run(args)
+    except (RuntimeError, OSError) as err:
+        sys.stderr.write(f'{err}\n')
+        return 2
+
+    print_result(result)
+
+    if args.json:
+        with open(args.json, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+"""
+A fake cutechess-cli for the benchmark of mabigat. It reads the engine names, -rounds and
+-games from the command line of match.py and prints the game and score lines of a match
+with random results, without starting the engines.
+"""
+
+
+import sys
+import random
+
+
+def get_value(args, name, default):
+    if name in args:
+        return args[args.index(name) + 1]
+    return default
+
+
+def main(argv):
+    names = []
+    for arg in argv:
+        if arg.startswith('name='):
+            names.append(arg.split('=', 1)[1])
+    if len(names) < 2:
+        names = ['engine1', 'engine2']
+
+    total = int(get_value(argv, '-rounds', 1)) * int(get_value(argv, '-games', 2))
+
+    wins, losses, draws = 0, 0, 0
+    for n in range(1, total + 1):
+        r = random.random()
+        if r < 0.4:
+            wins += 1
+            result = '1-0 {White mates}'
+        elif r < 0.8:
+            losses += 1
+            result = '0-1 {Black mates}'
+        else:
+            draws += 1
+            result = '1/2-1/2 {Draw by adjudication}'
+
+        print(f'Started game {n} of {total} ({names[0]} vs {names[1]})')
+        print(f'Finished game {n} ({names[0]} vs {names[1]}): {result}')
+        print(f'Score of {names[0]} vs {names[1]}: {wins} - {losses} - {draws}  '
+              f'[{(wins + draws / 2) / n:0.3f}] {n}', flush=True)
+
+    print('Finished match')
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""
+A fake uci engine for the benchmark of mabigat. It knows the uci, isready, setoption,
+gensfen, learn and quit commands of the nodchip stockfish, writes small files of random
+positions and prints learning lines like the real engine, without doing any work.
+
+If MABIGAT_BENCH_EVENTS is set, every engine start and every command is appended to that
+file, so the benchmark can count the engine starts and the handshakes.
+"""
+
+
+import sys
+import os
+import random
+
+
+OPTIONS = [
+    'Debug Log File type string default',
+    'Threads type spin default 1 min 1 max 512',
+    'Hash type spin default 16 min 1 max 33554432',
+    'EvalFile type string default nn.bin',
+    'EvalSaveDir type string default evalsave',
+    'Use NNUE type combo default true var true var false var pure',
+    'SkipLoadingEval type check default false',
+    'PruneAtShallowDepth type check default true',
+    'EnableTranspositionTable type check default true'
+]
+
+BIN_RECORD_SIZE = 40
+BINPACK_CHUNKS = 4
+
+
+class FakeEngine:
+    def __init__(self):
+        self.options = {}
+        self.log = None
+        self.events = os.environ.get('MABIGAT_BENCH_EVENTS')
+
+    def event(self, name):
+        if self.events:
+            with open(self.events, 'a') as f:
+                f.write(f'{os.getpid()} {name}\n')
+
+    def send(self, line):
+        """
+        Like the real engine, the output is also written to the debug log file.
+        """
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+        if self.log is not None:
+            self.log.write(f'<< {line}\n')
+            self.log.flush()
+
+    def set_option(self, line):
+        name, _, value = line[len('setoption name '):].partition(' value ')
+        self.options[name.lower()] = value
+        if name.lower() == 'debug log file':
+            if self.log is not None:
+                self.log.close()
+            self.log = open(value, 'a') if value else None
+
+    def gensfen(self, tokens):
+        fn = tokens[tokens.index('output_file_name') + 1]
+        num_pos = int(tokens[tokens.index('loop') + 1]) if 'loop' in tokens else 1000
+        num_pos = max(1, min(num_pos, 10000))
+
+        with open(fn, 'wb') as f:
+            if fn.endswith('.bin'):
+                f.write(os.urandom(num_pos * BIN_RECORD_SIZE))
+            else:
+                for _ in range(BINPACK_CHUNKS):
+                    data = os.urandom(num_pos * 2)
+                    f.write(b'BINP' + len(data).to_bytes(4, 'little') + data)
+
+        self.send('gensfen finished.')
+
+    def learn(self, tokens):
+        sfens = 0
+        for epoch in range(1, 4):
+            sfens += 1000000
+            self.send(f'PROGRESS (calc_loss): Sun Mar 28 01:20:13 2021, {sfens} sfens, 37313 sfens/second, epoch {epoch}')
+            self.send('  - learning rate = 1')
+            self.send(f'  - move accuracy = {random.uniform(0.3, 0.5) * epoch:0.4f}%')
+            self.send(f'val_loss       = {random.uniform(0.05, 0.1) / epoch:0.7f}')
+            self.send(f'train_loss = {random.uniform(0.15, 0.25) / epoch:0.6f}')
+
+        folder = os.path.join(self.options.get('evalsavedir', 'evalsave'), 'final')
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'nn.bin'), 'wb') as f:
+            f.write(os.urandom(1024))
+        self.send(f'INFO (save_eval): Finished saving evaluation file in {folder}')
+
+    def run(self):
+        self.event('start')
+        for raw in sys.stdin:
+            line = raw.strip()
+            if self.log is not None:
+                self.log.write(f'>> {line}\n')
+                self.log.flush()
+
+            tokens = line.split()
+            if not tokens:
+                continue
+
+            command = tokens[0]
+            if command != 'setoption':
+                self.event(command)
+
+            if command == 'uci':
+                self.send('id name FakeFish')
+                for option in OPTIONS:
+                    self.send(f'option name {option}')
+                self.send('uciok')
+            elif command == 'isready':
+                self.send('readyok')
+            elif command == 'setoption':
+                self.set_option(line)
+            elif command == 'gensfen':
+                self.gensfen(tokens)
+            elif command == 'learn':
+                self.learn(tokens)
+            elif command == 'quit':
+                break
+
+        if self.log is not None:
+            self.log.close()
+
+
+if __name__ == "__main__":
+    FakeEngine().run()
@@ -0,0 +1,294 @@
+#!/usr/bin/python
+
+"""
+Merges training positions files, removes duplicates and shuffles them with a fixed memory
+budget. It is used by mabigat and can also be run on its own. Example:
+
+python binpack_tool.py --output all.bin --exclude val.bin --dedup --shuffle --memory-mb 2048 a.bin b.bin
+
+bin files have records of 40 bytes, a packed sfen of 32 bytes followed by score, move,
+ply and result. Positions are removed and shuffled one by one.
+
+binpack files are a sequence of chunks, BINP, the chunk size and the compressed chains of
+positions. A position cannot be taken out of a chain, so binpack files are shuffled by
+chunks and only identical chunks are removed. Excluding the validation positions is not
+possible for binpack.
+"""
+
+
+import sys
+import os
+import argparse
+import random
+import hashlib
+import struct
+import tempfile
+import math
+import array
+import logging
+from pathlib import Path
+
+
+logger = logging.getLogger('mabigat.binpack_tool')
+
+
+BIN_RECORD_SIZE = 40
+BIN_SFEN_SIZE = 32
+BINPACK_MAGIC = b'BINP'
+BINPACK_HEADER_SIZE = 8
+READ_RECORDS = 65536
+
+# Bytes of memory of a record of a bucket, the record and its index, and with dedup the
+# hash of its packed sfen in a set.
+BIN_INDEX_SIZE = 8
+BIN_RECORD_MEMORY = 160
+
+
+def get_format(fn):
+    suffix = Path(fn).suffix.lower()
+    if suffix == '.bin':
+        return 'bin'
+    if suffix == '.binpack':
+        return 'binpack'
+    raise ValueError(f'{fn} is not a bin or binpack file')
+
+
+def read_records(fn):
+    """
+    Yields the 40 byte records of a bin file.
+    """
+    with open(fn, 'rb') as f:
+        while True:
+            block = f.read(BIN_RECORD_SIZE * READ_RECORDS)
+            if not block:
+                break
+            if len(block) % BIN_RECORD_SIZE:
+                raise ValueError(f'{fn} has a partial record, the file is not complete')
+            for i in range(0, len(block), BIN_RECORD_SIZE):
+                yield block[i:i + BIN_RECORD_SIZE]
+
+
+def read_chunks(fn):
+    """
+    Yields (offset, size) of the chunks of a binpack file, size includes the header.
+    """
+    with open(fn, 'rb') as f:
+        offset = 0
+        while True:
+            header = f.read(BINPACK_HEADER_SIZE)
+            if not header:
+                break
+            if len(header) < BINPACK_HEADER_SIZE or header[:4] != BINPACK_MAGIC:
+                raise ValueError(f'{fn} has no chunk header at {offset}')
+            size = struct.unpack('<I', header[4:])[0]
+            yield offset, size + BINPACK_HEADER_SIZE
+            f.seek(size, 1)
+            offset += size + BINPACK_HEADER_SIZE
+        if offset != f.tell():
+            raise ValueError(f'{fn} has a partial chunk, the file is not complete')
+
+
+def load_keys(fn):
+    """
+    Returns the packed sfens of a bin file.
+    """
+    return {record[:BIN_SFEN_SIZE] for record in read_records(fn)}
+
+
+def load_bucket(fn, dedup):
+    """
+    Returns the records of a bucket file as one bytes object and the array of the indexes
+    of the records to keep, the first of every packed sfen if dedup is True. Only the hash
+    of the packed sfen of every record is in a set, the records with the same hash are
+    then compared by their packed sfen.
+    """
+    data = Path(fn).read_bytes()
+    if len(data) % BIN_RECORD_SIZE:
+        raise ValueError(f'{fn} has a partial record, the file is not complete')
+    n = len(data) // BIN_RECORD_SIZE
+    if not dedup:
+        return data, array.array('L', range(n))
+
+    seen, collided = set(), set()
+    for offset in range(0, len(data), BIN_RECORD_SIZE):
+        h = hash(data[offset:offset + BIN_SFEN_SIZE])
+        if h in seen:
+            collided.add(h)
+        else:
+            seen.add(h)
+    del seen
+
+    index, first = array.array('L'), set()
+    for i in range(n):
+        key = data[i * BIN_RECORD_SIZE:i * BIN_RECORD_SIZE + BIN_SFEN_SIZE]
+        if hash(key) in collided:
+            if key in first:
+                continue
+            first.add(key)
+        index.append(i)
+    return data, index
+
+
+def merge_bin(inputs, out, exclude, shuffle, dedup, memory_bytes, rng, tmp_dir):
+    """
+    Positions are written to buckets by a salted hash of the packed sfen so that every
+    bucket fits in memory and duplicates are in the same bucket. Every bucket is then
+    loaded, deduped and shuffled. A bucket has memory_bytes / BIN_RECORD_MEMORY records,
+    the memory of a record in the bucket with its index and hash.
+    """
+    stats = {'positions': 0, 'duplicates': 0, 'excluded': 0}
+    excluded_keys = load_keys(exclude) if exclude is not None else set()
+
+    # Without dedup and shuffle the records are only copied.
+    if not shuffle and not dedup:
+        for fn in inputs:
+            for record in read_records(fn):
+                if record[:BIN_SFEN_SIZE] in excluded_keys:
+                    stats['excluded'] += 1
+                    continue
+                out.write(record)
+                stats['positions'] += 1
+        return stats
+
+    records = sum(os.path.getsize(fn) for fn in inputs) // BIN_RECORD_SIZE
+    record_memory = BIN_RECORD_MEMORY if dedup else BIN_RECORD_SIZE + BIN_INDEX_SIZE
+    num_buckets = max(1, math.ceil(records * record_memory / memory_bytes))
+    salt = rng.getrandbits(64).to_bytes(8, 'little')
+    logger.debug(f'{records} positions in {num_buckets} buckets')
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        buckets = [open(Path(tmp, f'bucket_{i}.bin'), 'wb') for i in range(num_buckets)]
+        try:
+            for fn in inputs:
+                for record in read_records(fn):
+                    key = record[:BIN_SFEN_SIZE]
+                    if key in excluded_keys:
+                        stats['excluded'] += 1
+                        continue
+                    i = 0
+                    if num_buckets > 1:
+                        digest = hashlib.blake2b(key, digest_size=8, key=salt).digest()
+                        i = int.from_bytes(digest, 'little') % num_buckets
+                    buckets[i].write(record)
+        finally:
+            for bucket in buckets:
+                bucket.close()
+
+        for i in range(num_buckets):
+            fn = Path(tmp, f'bucket_{i}.bin')
+            data, index = load_bucket(fn, dedup)
+            stats['duplicates'] += len(data) // BIN_RECORD_SIZE - len(index)
+            if shuffle:
+                rng.shuffle(index)
+            for start in range(0, len(index), READ_RECORDS):
+                out.write(b''.join(data[j * BIN_RECORD_SIZE:(j + 1) * BIN_RECORD_SIZE]
+                                   for j in index[start:start + READ_RECORDS]))
+            stats['positions'] += len(index)
+            del data, index
+            fn.unlink()
+
+    return stats
+
+
+def merge_binpack(inputs, out, shuffle, dedup, rng):
+    """
+    Copies the chunks, only the chunk index is in memory.
+    """
+    stats = {'chunks': 0, 'duplicates': 0}
+    index = [(fn, offset, size) for fn in inputs for offset, size in read_chunks(fn)]
+    if shuffle:
+        rng.shuffle(index)
+
+    digests = set()
+    files = {}
+    try:
+        for fn, offset, size in index:
+            if fn not in files:
+                files[fn] = open(fn, 'rb')
+            f = files[fn]
+            f.seek(offset)
+            chunk = f.read(size)
+            if dedup:
+                digest = hashlib.blake2b(chunk, digest_size=16).digest()
+                if digest in digests:
+                    stats['duplicates'] += 1
+                    continue
+                digests.add(digest)
+            out.write(chunk)
+            stats['chunks'] += 1
+    finally:
+        for f in files.values():
+            f.close()
+
+    return stats
+
+
+def merge(inputs, output, exclude=None, shuffle=False, dedup=False, memory_mb=1024,
+          seed=None, tmp_dir=None):
+    """
+    Merges the inputs into output, output can be one of the inputs. Returns the stats
+    of the merge.
+    """
+    if memory_mb <= 0:
+        raise ValueError(f'memory_mb = {memory_mb}, should be more than 0')
+
+    fmt = get_format(output)
+    for fn in inputs:
+        if get_format(fn) != fmt:
+            raise ValueError(f'{fn} and {output} have different formats')
+
+    rng = random.Random(seed)
+    if tmp_dir is None:
+        tmp_dir = Path(output).resolve().parent
+
+    # The output is renamed only when it is complete.
+    tmp = Path(output).with_name(f'{Path(output).name}.{os.getpid()}.tmp')
+    try:
+        with open(tmp, 'wb') as out:
+            if fmt == 'bin':
+                stats = merge_bin(inputs, out, exclude, shuffle, dedup,
+                                  memory_mb * 1024 * 1024, rng, tmp_dir)
+            else:
+                if exclude is not None:
+                    logger.info('positions in the exclude file are not removed from binpack')
+                stats = merge_binpack(inputs, out, shuffle, dedup, rng)
+        os.replace(tmp, output)
+    finally:
+        if tmp.is_file():
+            tmp.unlink()
+
+    logger.debug(f'merged {len(inputs)} files into {output}, {stats}')
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Merge, dedup and shuffle bin or binpack training positions.')
+    parser.add_argument('inputs', nargs='+', help='The bin or binpack files to merge.')
+    parser.add_argument('--output', required=True, help='The merged file, it can be one of the inputs.')
+    parser.add_argument('--exclude', help='Remove the positions in this bin file, like the validation file.')
+    parser.add_argument('--dedup', action='store_true', help='Remove duplicate positions.')
+    parser.add_argument('--shuffle', action='store_true', help='Shuffle the positions.')
+    parser.add_argument('--memory-mb', type=int, default=1024,
+                        help='The memory used by dedup and shuffle, default=1024.')
+    parser.add_argument('--seed', type=int, help='The seed of the shuffle.')
+    parser.add_argument('--tmp-dir', help='The folder of the temp files, default is the output folder.')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+
+    try:
+        stats = merge(args.inputs, args.output, exclude=args.exclude, shuffle=args.shuffle,
+                      dedup=args.dedup, memory_mb=args.memory_mb, seed=args.seed,
+                      tmp_dir=args.tmp_dir)
+    except (ValueError, OSError) as err:
+        sys.stderr.write(f'{err}\n')
+        return 2
+
+    print(stats)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
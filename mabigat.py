@@ -16,19 +16,39 @@ __credits__ = ['musketeerchess']
 
 
 import sys
+import os
 import subprocess
+import multiprocessing
+import shlex
+import socket
+import concurrent.futures
+import threading
+import asyncio
+import signal
+import http.server
 from pathlib import Path
 import shutil
+import errno
 import logging
 import argparse
 import configparser
 import ast
 import copy
 import time
+import hashlib
+import json
+import csv
+import io
+import random
+import re
+import math
+import gzip
 
 import optuna
+import binpack_tool
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
+import plotly.offline
 
 
 logger = logging.getLogger('mabigat')
@@ -49,6 +69,15 @@ except ModuleNotFoundError:
     print('Warning! pandas is not installed.')
 
 
+# Learning reports its val_loss to the pruner at steps 1, 2, ... and the match reports
+# its partial score after this offset plus the number of games, so that the pruner only
+# compares learning with learning and match with match.
+MATCH_STEP_OFFSET = 1000000
+
+# Seconds between looks for the net of another trial when there is no opponent yet.
+OPPONENT_WAIT = 10
+
+
 LEARNING_FLAG_PARAMS = [
     'set_recommended_uci_options', 'save_only_once',
     'no_shuffle', 'assume_quiet', 'smart_fen_skipping',
@@ -56,20 +85,343 @@ LEARNING_FLAG_PARAMS = [
 ]
 
 
+# The options of an engine binary, engine key: {option name in lower case: [name, default]}
+engine_options_cache = {}
+
+
+def get_engine_key(enginefn):
+    """
+    Returns the key of the engine binary, the options are discovered again when the
+    engine file is replaced.
+    """
+    engine = Path(enginefn).resolve()
+    stat = engine.stat()
+    return f'{engine}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def parse_uci_option(line):
+    """
+    Returns (name, default) from a line like
+    option name Hash type spin default 16 min 1 max 33554432
+    The default of a button is None.
+    """
+    name, _, rest = line[len('option name '):].partition(' type ')
+    if ' default' not in f' {rest}':
+        return name, None
+    default = f' {rest} '.split(' default ', 1)[1]
+    for token in [' min ', ' max ', ' var ']:
+        default = default.split(token)[0]
+    return name, default.strip()
+
+
+def get_engine_options_info(enginefn, cache_file=None):
+    """
+    Returns {option name in lower case: [name, default]} of the engine. The options are
+    cached in memory and in cache_file so that the engine is only started once for a
+    given engine binary.
+    """
+    key = get_engine_key(enginefn)
+    if key in engine_options_cache:
+        return engine_options_cache[key]
+
+    cached = {}
+    if cache_file is not None and Path(cache_file).is_file():
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+
+    if key not in cached:
+        session = EngineSession(enginefn)
+        session.start()
+        session.quit()
+        cached[key] = session.defaults
+
+        if cache_file is not None:
+            tmp = f'{cache_file}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(cached, f, indent=1)
+            os.replace(tmp, cache_file)
+
+    engine_options_cache[key] = cached[key]
+    return cached[key]
+
+
+class EngineError(Exception):
+    """
+    The engine crashed, did not reply in time or stopped its output.
+    """
+
+
+# The event loop that drives the uci engines of this process.
+_engine_loop = None
+_engine_loop_lock = threading.Lock()
+
+
+def get_engine_loop():
+    """
+    Returns the event loop that runs in its own thread. The engines of all the threads
+    in this process, like position generation in pipeline mode, share this loop.
+    """
+    global _engine_loop
+    with _engine_loop_lock:
+        if _engine_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='uci', daemon=True).start()
+            _engine_loop = loop
+    return _engine_loop
+
+
+class EngineSession:
+    """
+    A running uci engine that is used by several stages of a trial. Only the options that
+    are different from the current values of the engine are sent, so a big hash is not
+    allocated again at every stage. Options that a stage does not set are reset to the
+    engine default.
+
+    The engine pipes are read by the event loop. uci and isready should get a reply within
+    ready_timeout seconds and during gensfen and learn, the engine is considered hung if it
+    has no output for stall_timeout seconds, 0 means no limit. A hung engine is killed with
+    the processes it started and EngineError is raised.
+    """
+    def __init__(self, enginefn, ready_timeout=120, stall_timeout=0):
+        self.enginefn = enginefn
+        self.ready_timeout = ready_timeout or None
+        self.stall_timeout = stall_timeout or None
+        self.loop = get_engine_loop()
+        self.proc = None
+        self.defaults = {}  # {option name in lower case: [name, default]}
+        self.current = {}   # {option name in lower case: value}
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _send(self, command):
+        self.proc.stdin.write(f'{command}\n'.encode())
+        try:
+            await self.proc.stdin.drain()
+        except ConnectionError:
+            raise EngineError(f'engine does not read the command {command}') from None
+
+    async def _kill(self):
+        """
+        Kills the engine and the processes that it started.
+        """
+        proc, self.proc = self.proc, None
+        if proc is None or proc.returncode is not None:
+            return
+        if os.name == 'nt':
+            subprocess.call(['taskkill', '/F', '/T', '/PID', str(proc.pid)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        await proc.wait()
+
+    async def _readline(self, timeout):
+        try:
+            data = await asyncio.wait_for(self.proc.stdout.readline(), timeout)
+        except asyncio.TimeoutError:
+            await self._kill()
+            raise EngineError(f'engine is killed, there is no output in {timeout}s') from None
+        if not data:
+            code = await self.proc.wait()
+            self.proc = None
+            raise EngineError(f'engine exited with code {code}')
+        return data.decode(errors='replace').strip()
+
+    async def _read_until(self, token, timeout):
+        """
+        Returns the lines until the line with token. The reply should come within timeout
+        seconds.
+        """
+        async def read():
+            lines = []
+            while True:
+                line = await self._readline(None)
+                lines.append(line)
+                if token in line:
+                    return lines
+
+        try:
+            return await asyncio.wait_for(read(), timeout)
+        except asyncio.TimeoutError:
+            await self._kill()
+            raise EngineError(f'engine is killed, there is no {token} in {timeout}s') from None
+
+    async def _start(self):
+        self.proc = await asyncio.create_subprocess_exec(
+            self.enginefn, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            limit=1 << 20,
+            start_new_session=os.name != 'nt')
+        await self._send('uci')
+        return await self._read_until('uciok', self.ready_timeout)
+
+    async def _quit(self, timeout):
+        if self.proc is None:
+            return
+        try:
+            await self._send('quit')
+            await asyncio.wait_for(self.proc.wait(), timeout)
+            self.proc = None
+        except (EngineError, asyncio.TimeoutError):
+            await self._kill()
+
+    async def _command(self, command, token):
+        """
+        Sends the command and reads the output until the line with token.
+        """
+        await self._send(command)
+        while True:
+            line = await self._readline(self.stall_timeout)
+            if token in line.lower():
+                return
+
+    def send(self, command):
+        self.run(self._send(command))
+
+    def lines(self):
+        """
+        Returns the lines of the engine output. EngineError is raised when the engine exits
+        or has no output for stall_timeout seconds.
+        """
+        while True:
+            yield self.run(self._readline(self.stall_timeout))
+
+    def read_until(self, token):
+        self.run(self._read_until(token, self.ready_timeout))
+
+    def running(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    def start(self):
+        """
+        Starts the engine if it is not running.
+        """
+        if self.running():
+            return
+
+        self.defaults = {}
+        for line in self.run(self._start()):
+            # option name Debug Log File type string default
+            if line.startswith('option name'):
+                name, default = parse_uci_option(line)
+                self.defaults[name.lower()] = [name, default]
+
+        self.current = {k: v[1] for k, v in self.defaults.items()}
+
+    def set_options(self, options):
+        """
+        Sets the options, a list of (name, value), options that are not in the list are
+        reset to their defaults. Returns the number of options sent.
+        """
+        wanted = {}
+        for name, value in options:
+            wanted[name.lower()] = (name, str(value))
+
+        changes = []
+        for k, (name, value) in wanted.items():
+            if self.current.get(k) != value:
+                changes.append((k, name, value))
+        for k, (name, default) in self.defaults.items():
+            if k not in wanted and default is not None and self.current.get(k) != default:
+                changes.append((k, name, default))
+
+        for k, name, value in changes:
+            self.send(f'setoption name {name} value {value}')
+            self.current[k] = value
+
+        return len(changes)
+
+    def forget_options(self):
+        """
+        Forgets the option values that were sent, after a command that can change options
+        inside the engine like gensfen with set_recommended_uci_options. All the options
+        are sent again by the next set_options.
+        """
+        self.current = {}
+
+    def ready(self):
+        self.send('isready')
+        self.read_until('readyok')
+
+    def new_game(self):
+        self.send('ucinewgame')
+        self.ready()
+
+    def quit(self, timeout=3):
+        """
+        Stops the engine, it is killed if it does not quit like when it is busy learning.
+        """
+        self.run(self._quit(timeout))
+
+
 class TrainingSFNNUE:
-    def __init__(self, enginefn, engine_options, ini_file,
+    def __init__(self, enginefn, engine_options, config,
                  sub_study_folder='log', eval_save_dir='evalsave'):
         self.enginefn = enginefn
         self.engine_options = engine_options
-        self.ini_file = ini_file
+        self.config = config
         self.sub_study_folder = sub_study_folder
         self.eval_save_dir = eval_save_dir
-        self.engine_option_names = self.get_engine_option_names()
-        self.training_pos = get_num_positions(ini_file, mode='train')
-        self.validation_pos = get_validation_count(ini_file)
+        self.engine_option_names = list(get_engine_options_info(
+            enginefn, cache_file=f'{sub_study_folder}/engine_options.json'))
+        self.session = EngineSession(enginefn, ready_timeout=config.engine_ready_timeout,
+                                     stall_timeout=config.engine_stall_timeout)
+        self.gensfen_shards = config.gensfen_shards
+        self.shard_sessions = []
+        self.training_pos = config.numpos_train
+        self.validation_pos = config.validation_count
+        self.learning_plot_interval = config.learning_plot_interval
+        self.sflog_tailer = None
+        self.last_plot_time = 0
+
+        # Seconds spent on the learning plot and the sfens/second of the last learning.
+        self.plot_time = 0.0
+        self.learn_speeds = []
+
+        # The progress of gensfen and learn is shown in the worker status if it is set.
+        self.status = None
+
+    def prepare_engine(self, options, session=None):
+        """
+        Starts the engine if it is not running yet and sets the engine options of the
+        stage. The engine options from the ini file come first, options in the list
+        of (name, value) override them.
+        """
+        if session is None:
+            session = self.session
+
+        session_options = []
+        for n in self.engine_options:
+            for k, v in n.items():
+                if k.lower() == 'debug log file' or k.lower() == 'engine_file':
+                    continue
+                session_options.append((k, v))
+        session_options += options
 
-    def send(self, proc, command):
-        proc.stdin.write(f'{command}\n')
+        session.start()
+        num_sent = session.set_options(session_options)
+        logger.debug(f'engine options sent: {num_sent}')
+
+        session.ready()
+        session.new_game()
+
+    def get_shard_session(self, shard):
+        while len(self.shard_sessions) <= shard:
+            self.shard_sessions.append(EngineSession(self.enginefn, ready_timeout=self.config.engine_ready_timeout,
+                                                     stall_timeout=self.config.engine_stall_timeout))
+        return self.shard_sessions[shard]
+
+    def close(self):
+        self.session.quit()
+        for session in self.shard_sessions:
+            session.quit()
 
     def generate_positions(
             self,
@@ -78,28 +430,162 @@ class TrainingSFNNUE:
             study_name,
             output_fn,
             generation_param,
-            generation_param_to_optimze
+            generation_param_to_optimze,
+            cache=None
     ):
-        eng = subprocess.Popen(self.enginefn, stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.STDOUT,
-                               universal_newlines=True, bufsize=1)
+        """
+        Generates positions with the gensfen command. If cache is given and it has the
+        positions of the same command, engine and book, the cached positions are used.
+        Returns True if the positions are from the cache.
+        """
+        params, eng_opt = self.get_gensfen_params(generation_param, generation_param_to_optimze)
+
+        key = None
+        if cache is not None:
+            key = self.get_gensfen_key(generation_param, generation_param_to_optimze)
+            if cache.get(key, output_fn):
+                logger.info(f'done {mode} data generation, reused cached positions {key[:12]}')
+                return True
+
+        if self.gensfen_shards > 1 and get_param_value(generation_param_to_optimze + generation_param, 'num_pos'):
+            self.generate_shards(num_trials, mode, study_name, output_fn, generation_param,
+                                 generation_param_to_optimze, eng_opt)
+            logger.info(f'done {mode} data generation')
+            if cache is not None:
+                cache.put(key, output_fn)
+            return False
+
+        # Set options, the latest engine options are from generation_param.
+        # No engine option names should be in generation_param_to_optimze.
+        options = [('Debug Log File', f'{self.sub_study_folder}/{mode}_{study_name}_trial_{num_trials}_sflog.txt')]
+        for n in eng_opt:
+            options += list(n.items())
+        self.prepare_engine(options)
 
-        self.send(eng, 'uci')
+        # Build the command line to generate the positions.
+        cmd = f'gensfen output_file_name {output_fn}{params}'
 
-        for eline in iter(eng.stdout.readline, ''):
-            line = eline.strip()
-            if 'uciok' in line:
+        logger.debug(f'command line: {cmd}')
+
+        # Execute the command line.
+        self.session.send(f'{cmd}')
+        self.session.forget_options()
+
+        for line in self.session.lines():
+            if 'gensfen finished' in line.lower():
                 break
+            if self.status is not None:
+                speed = parse_sfens_per_second(line)
+                if speed is not None:
+                    self.status.progress(f'{mode}_gen', sfens_per_second=speed)
 
-        # Set options
-        self.send(eng, f'setoption name Debug Log File value {self.sub_study_folder}/{mode}_{study_name}_trial_{num_trials}_sflog.txt')
-        for n in self.engine_options:
-            for k, v in n.items():
-                if k.lower() == 'debug log file' or k.lower() == 'engine_file':
-                    continue
-                self.send(eng, f'setoption name {k} value {v}')
+        logger.info(f'done {mode} data generation')
+
+        if cache is not None:
+            wait_for_file(output_fn)
+            cache.put(key, output_fn)
+
+        return False
+
+    def generate_shards(
+            self,
+            num_trials,
+            mode,
+            study_name,
+            output_fn,
+            generation_param,
+            generation_param_to_optimze,
+            eng_opt
+    ):
+        """
+        Generates the positions with gensfen_shards engines at the same time. Every shard
+        generates its part of num_pos with its own seed and its own slice of an epd book,
+        the engine threads and hash are split between the shards. The shard files are
+        joined into output_fn, binpack chunks and bin records can be concatenated.
+        A finished shard is kept as a done file and is not generated again.
+        """
+        shards = self.gensfen_shards
+        output = Path(output_fn)
+        all_param = generation_param_to_optimze + generation_param
+        num_pos = int(get_param_value(all_param, 'num_pos'))
+        seed = get_param_value(all_param, 'seed') or str(random.getrandbits(32))
+        book = get_param_value(all_param, 'book')
+
+        # Every shard gets every nth line of an epd book.
+        book_lines = None
+        if book is not None and book.lower().endswith('.epd') and Path(book).is_file():
+            with open(book) as f:
+                book_lines = [line for line in f if line.strip()]
+
+        threads = max(1, int(get_param_value(self.engine_options, 'threads') or 1) // shards)
+        hash_mb = max(1, int(get_param_value(self.engine_options, 'hash') or 16) // shards)
+
+        done_files, jobs = [], []
+        for i in range(shards):
+            shard_fn = output.with_name(f'{output.stem}_shard{i}{output.suffix}')
+            done_fn = output.with_name(f'{output.stem}_shard{i}.done{output.suffix}')
+            done_files.append(done_fn)
+            shard_pos = num_pos // shards + (1 if i < num_pos % shards else 0)
+            if done_fn.is_file() or shard_pos == 0:
+                continue
+
+            replace = {'num_pos': shard_pos, 'seed': f'{seed}_{i}'}
+            if book_lines is not None:
+                shard_book = output.with_name(f'{output.stem}_book{i}.epd')
+                with open(shard_book, 'w') as f:
+                    f.writelines(book_lines[i::shards] or book_lines)
+                replace['book'] = shard_book.as_posix()
+
+            shard_param = replace_param_values(generation_param, replace)
+            if get_param_value(all_param, 'seed') is None:
+                shard_param.append({'seed': replace['seed']})
+            shard_param_to_optimize = replace_param_values(generation_param_to_optimze, replace)
+            params, _ = self.get_gensfen_params(shard_param, shard_param_to_optimize)
+
+            options = [('Debug Log File', f'{self.sub_study_folder}/{mode}_{study_name}_trial_{num_trials}_shard{i}_sflog.txt')]
+            for n in eng_opt:
+                options += list(n.items())
+            options += [('Threads', threads), ('Hash', hash_mb)]
+
+            session = self.get_shard_session(i)
+            self.prepare_engine(options, session=session)
+
+            cmd = f'gensfen output_file_name {shard_fn}{params}'
+            logger.debug(f'shard {i} command line: {cmd}')
+            jobs.append((session, cmd, shard_fn, done_fn))
+
+        async def run_shard(session, cmd, shard_fn, done_fn):
+            # A shard is done as soon as it is finished, even if another shard fails later.
+            session.forget_options()
+            await session._command(cmd, 'gensfen finished')
+            # The wait is in a thread to not block the other shards on the engine loop.
+            await asyncio.get_running_loop().run_in_executor(None, wait_for_file, shard_fn)
+            os.replace(shard_fn, done_fn)
+
+        async def run_shards():
+            await asyncio.gather(*[run_shard(*job) for job in jobs])
+
+        logger.info(f'generating {num_pos} positions with {len(jobs)} of {shards} shards ...')
+        try:
+            self.session.run(run_shards())
+        except EngineError:
+            # The other shards are stopped, shards that were already done are kept.
+            for session, _, _, _ in jobs:
+                session.quit()
+            raise
+
+        # Join the shards.
+        binpack_tool.merge([fn for fn in done_files if fn.is_file()], output_fn)
+
+        for i, done_fn in enumerate(done_files):
+            done_fn.unlink(missing_ok=True)
+            output.with_name(f'{output.stem}_book{i}.epd').unlink(missing_ok=True)
 
+    def get_gensfen_params(self, generation_param, generation_param_to_optimze):
+        """
+        Returns the gensfen params that follow the output_file_name and the list of dict
+        of engine options found in generation_param.
+        """
         # Find an engine option names that are included in generation_param.
         # We don't include them in gensfen command.
         # Also save the dict that are engine options.
@@ -111,73 +597,77 @@ class TrainingSFNNUE:
                     eng_opt.append(n)  # list of dict
                     break
 
-        # Send the latest engine options.
-        if len(eng_opt):
-            for n in eng_opt:
-                for k, v in n.items():
-                    self.send(eng, f'setoption name {k} value {v}')
-
-        # No engine option names should be in generation_param_to_optimze.
-
-        self.send(eng, 'isready')
-        for eline in iter(eng.stdout.readline, ''):
-            line = eline.strip()
-            if 'readyok' in line:
-                break
-
-        self.send(eng, 'ucinewgame')
-        self.send(eng, 'isready')
-        for eline in iter(eng.stdout.readline, ''):
-            line = eline.strip()
-            if 'readyok' in line:
-                break
-
-        # Build the command line to generate the positions.
-        cmd = f'gensfen output_file_name {output_fn}'
+        params = ''
 
         # Add param to be optimized.
         for par in generation_param_to_optimze:
             for k, v in par.items():
                 kval = k.lower()
                 if kval == 'set_recommended_uci_options':
-                    cmd += f' {k}'
+                    params += f' {k}'
                 elif kval == 'ensure_quiet':
-                    cmd += f' {k}'
+                    params += f' {k}'
                 elif kval == 'num_pos':
-                    cmd += f' loop {v}'
+                    params += f' loop {v}'
                 elif kval in excluded:
                     continue
                 else:
-                    cmd += f' {k} {v}'
+                    params += f' {k} {v}'
 
         # Add the param that is not to be optimized.
         for par in generation_param:
             for k, v in par.items():
                 kval = k.lower()
                 if kval == 'set_recommended_uci_options':
-                    cmd += f' {k}'
+                    params += f' {k}'
                 elif kval == 'ensure_quiet':
-                    cmd += f' {k}'
+                    params += f' {k}'
                 elif kval == 'num_pos':
-                    cmd += f' loop {v}'
+                    params += f' loop {v}'
                 elif kval in excluded:
                     continue
                 else:
-                    cmd += f' {k} {v}'
+                    params += f' {k} {v}'
 
-        logger.debug(f'command line: {cmd}')
+        return params, eng_opt
 
-        # Execute the command line.
-        self.send(eng, f'{cmd}')
+    def get_gensfen_key(self, generation_param, generation_param_to_optimze):
+        """
+        Returns a hash of everything that affects the generated positions, the gensfen params,
+        the engine options, the engine binary and the book. The params are sorted so that the
+        order in the ini file does not matter.
+        """
+        book = None
+        gensfen, options = [], []
+        for n in generation_param_to_optimze + generation_param:
+            for k, v in n.items():
+                kval = k.lower()
+                if kval == 'book':
+                    book = v
+                if kval in self.engine_option_names:
+                    options.append(f'{kval}={v}')
+                else:
+                    gensfen.append(f'{kval}={v}')
 
-        for eline in iter(eng.stdout.readline, ''):
-            line = eline.strip()
-            if 'gensfen finished' in line.lower():
-                break
+        for n in self.engine_options:
+            for k, v in n.items():
+                # These options do not change the positions.
+                if k.lower() in ['debug log file', 'engine_file', 'threads']:
+                    continue
+                options.append(f'{k.lower()}={v}')
 
-        logger.info(f'done {mode} data generation')
+        content = {
+            'gensfen': sorted(gensfen),
+            'options': sorted(options),
+            'engine': get_file_digest(self.enginefn),
+            'book': get_file_digest(book) if book is not None and Path(book).is_file() else book
+        }
 
-        self.send(eng, 'quit')
+        # The shards have their own seeds and books.
+        if self.gensfen_shards > 1:
+            content['shards'] = self.gensfen_shards
+
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
 
     def learn(
             self,
@@ -186,29 +676,15 @@ class TrainingSFNNUE:
             target_dir,
             validation_set_file_name,
             learning_param,
-            learning_param_to_optimize
+            learning_param_to_optimize,
+            trial=None,
+            report_interval=1
     ):
-        eng = subprocess.Popen(self.enginefn, stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.STDOUT,
-                               universal_newlines=True, bufsize=1)
-
-        self.send(eng, 'uci')
-
-        for eline in iter(eng.stdout.readline, ''):
-            line = eline.strip()
-            if 'uciok' in line:
-                break
-
-        # Set options
-        self.send(eng, f'setoption name Debug Log File value {self.sub_study_folder}/learn_{study_name}_trial_{num_trials}_sflog.txt')
-        self.send(eng, f'setoption name EvalSaveDir value {self.eval_save_dir}')
-        for n in self.engine_options:
-            for k, v in n.items():
-                if k.lower() == 'debug log file' or k.lower() == 'engine_file':
-                    continue
-                self.send(eng, f'setoption name {k} value {v}')
-
+        """
+        Learns the net from the positions in target_dir. If trial is given, the negative
+        val_loss is reported to the optimizer and learning is stopped with optuna.TrialPruned
+        if the pruner decides that the trial is not promising.
+        """
         # Find an engine option names that are included in learning_param.
         # We don't include them in learn command.
         # Also save the dict that are engine options.
@@ -220,25 +696,14 @@ class TrainingSFNNUE:
                     eng_opt.append(n)  # list of dict
                     break
 
-        # Send the latest engine options.
-        if len(eng_opt):
-            for n in eng_opt:
-                for k, v in n.items():
-                    self.send(eng, f'setoption name {k} value {v}')
-
-        self.send(eng, 'isready')
-        for eline in iter(eng.stdout.readline, ''):
-            line = eline.strip()
-            if 'readyok' in line:
-                break
-
-        self.send(eng, 'ucinewgame')
-        self.send(eng, 'isready')
-
-        for eline in iter(eng.stdout.readline, ''):
-            line = eline.strip()
-            if 'readyok' in line:
-                break
+        # Set options, the latest engine options are from learning_param.
+        options = [
+            ('Debug Log File', f'{self.sub_study_folder}/learn_{study_name}_trial_{num_trials}_sflog.txt'),
+            ('EvalSaveDir', self.eval_save_dir)
+        ]
+        for n in eng_opt:
+            options += list(n.items())
+        self.prepare_engine(options)
 
         cmd = f'learn targetdir {target_dir}'
         cmd += f' validation_set_file_name {validation_set_file_name}'
@@ -267,27 +732,78 @@ class TrainingSFNNUE:
 
         logger.debug(f'command line: {cmd}')
 
-        self.send(eng, f'{cmd}')
+        self.session.send(f'{cmd}')
 
-        for eline in iter(eng.stdout.readline, ''):
-            line = eline.strip()
+        val_losses, move_accuracies, move_accuracy = [], [], None
+        self.sflog_tailer, self.last_plot_time = None, 0
+        self.plot_time, self.learn_speeds = 0.0, []
+
+        for line in self.session.lines():
             if 'finished saving evaluation file' in line.lower() and '/final' in line.lower():
                 break
             else:
+                # PROGRESS (calc_loss): Sun Mar 28 01:20:13 2021, 1000000 sfens, 37313 sfens/second, epoch 1
+                if 'PROGRESS' in line:
+                    speed = parse_sfens_per_second(line)
+                    if speed is not None:
+                        self.learn_speeds.append(speed)
+                    if self.status is not None and 'epoch ' in line:
+                        self.status.progress('learn', epoch=int(line.split('epoch ')[1].split()[0]),
+                                             sfens_per_second=speed)
+
+                # - move accuracy = 0.4875%
+                if 'move accuracy = ' in line and not 'random move accuracy = ' in line:
+                    move_accuracy = float(line.split('move accuracy = ')[1].split('%')[0])
+
+                # val_loss       = 0.0782639
                 if 'val_loss' in line:
+                    if self.status is not None:
+                        self.status.progress('learn', val_loss=float(line.split('= ')[1]))
                     self.plot_engine_learning(study_name, num_trials)
 
-        self.send(eng, 'quit')
+                    if trial is not None and report_interval > 0:
+                        val_losses.append(float(line.split('= ')[1]))
+                        move_accuracies.append(move_accuracy)
+                        step = len(val_losses)
+                        if step % report_interval:
+                            continue
+
+                        # We are maximizing, lower val_loss is better.
+                        trial.report(-val_losses[-1], step=step)
+                        trial.set_user_attr('learn_val_loss', val_losses)
+                        trial.set_user_attr('learn_move_accuracy', move_accuracies)
+
+                        if trial.should_prune():
+                            logger.info(f'learning is pruned at val_loss report {step}, val_loss: {val_losses[-1]}')
+                            # The engine does not read commands while learning, it is
+                            # killed and started again in the next stage.
+                            self.session.quit()
+                            raise optuna.TrialPruned()
+
+        # Plot all the values of this learning.
+        self.plot_engine_learning(study_name, num_trials, force=True)
 
         logger.info('done learning')
 
-    def plot_engine_learning(self, study_name, num_trials):
+    def plot_engine_learning(self, study_name, num_trials, force=False):
         """
-        Plot data from learning like , val and train loses.
+        Plot data from learning like , val and train loses. Only the new lines of the sflog
+        are read and the plot is written at most once every learning_plot_interval seconds
+        unless force is True.
         """
+        plot_start = time.perf_counter()
         try:
             sflog = f'{self.sub_study_folder}/learn_{study_name}_trial_{num_trials}_sflog.txt'
-            val_loss, train_loss, sfens, epochs, lr, move_acc = plot_val_train_loss(sflog)
+            if self.sflog_tailer is None or self.sflog_tailer.sflog != sflog:
+                self.sflog_tailer = SFLogTailer(sflog)
+            self.sflog_tailer.update()
+
+            now = time.perf_counter()
+            if not force and now - self.last_plot_time < self.learning_plot_interval:
+                return
+            self.last_plot_time = now
+
+            val_loss, train_loss, sfens, epochs, lr, move_acc = self.sflog_tailer.series()
 
             # Attempt to plot if there values in val and train losses.
             if len(val_loss) and len(train_loss):
@@ -328,685 +844,1555 @@ class TrainingSFNNUE:
                                   title_text=f"Learning, trainpos: {self.training_pos}, valpos: {self.validation_pos}",
                                   legend_title="Legend")
 
-                include_plotlyjs = True
+                # plotly.min.js is loaded from the study folder.
+                write_plotlyjs(self.sub_study_folder)
+                include_plotlyjs = 'directory'
                 full_html, auto_play = False, False
                 with open(f'{self.sub_study_folder}/{study_name}_trial_{num_trials}_learning_plot.html', 'w') as f:
                     f.write(fig.to_html(full_html=full_html, include_plotlyjs=include_plotlyjs, auto_play=auto_play))
 
         except Exception as err:
             logger.warning(f'warning in plotting val_loss and val_train as {err}')
+        finally:
+            self.plot_time += time.perf_counter() - plot_start
 
-    def get_engine_option_names(self):
-        option_names = []
-        eng = subprocess.Popen(self.enginefn, stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.STDOUT,
-                               universal_newlines=True, bufsize=1)
-        self.send(eng, 'uci')
 
-        for eline in iter(eng.stdout.readline, ''):
-            line = eline.strip()
-            # option name Debug Log File type string default
-            if line.startswith('option name'):
-                value = line.split('option name ')[1].split(' type')[0]
-                option_names.append(value.lower())
-            if 'uciok' in line:
-                break
+class BinpackCache:
+    """
+    Content addressed store of generated positions. Every entry is a file named by the hash
+    of how it was generated. When the total size exceeds the quota, the least recently used
+    entries are removed.
+    """
+    def __init__(self, folder, quota_mb=0):
+        self.folder = Path(folder)
+        self.quota_bytes = quota_mb * 1024 * 1024
+        self.folder.mkdir(parents=True, exist_ok=True)
 
-        self.send(eng, 'quit')
+    def entry(self, key):
+        return Path(self.folder, f'{key}.binpack')
 
-        return option_names
+    def get(self, key, dst):
+        """
+        Puts the cached positions at dst, returns False if there is no entry for key.
+        """
+        src = self.entry(key)
+        try:
+            link_or_copy(src, dst)
+        except FileNotFoundError:
+            return False
+
+        # Mark as recently used.
+        os.utime(src)
+        return True
+
+    def put(self, key, src):
+        dst = self.entry(key)
+        tmp = Path(self.folder, f'{key}.{os.getpid()}.tmp')
+        link_or_copy(src, tmp)
+        os.replace(tmp, dst)
+        self.evict(keep=dst)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache is within the quota.
+        """
+        if self.quota_bytes <= 0:
+            return
 
+        entries = []
+        for fn in self.folder.glob('*.binpack'):
+            try:
+                st = fn.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fn))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, fn in sorted(entries):
+            if total <= self.quota_bytes:
+                break
+            if keep is not None and fn == keep:
+                continue
+            try:
+                fn.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.debug(f'evicted cached positions {fn.name}')
 
-def delete_folder(folder: str):
-    folder_path = Path(folder)
-    if folder_path.is_dir():
-        shutil.rmtree(folder_path)
 
+class RetentionPolicy:
+    """
+    Limits the disk space of the nets and positions that are kept for every trial. The
+    artifacts of the best retention_top_k trials are kept, the others are compressed or
+    deleted. When the artifacts exceed the quota, those of the worst trials are deleted
+    first. The net of the best trial is never touched as it is the opponent in the match,
+    and neither is the net of trial 0 when it is the fixed opponent. Trials that are not
+    finished are not touched. With a match ledger the trials are ranked by the elo of
+    their nets from all the matches, like the choice of the opponent. Positions that are
+    hard links to the val_cache or the training data store use no space of their own,
+    they are not compressed and not counted in the quota.
+    """
+    FINISHED_STATES = [
+        optuna.trial.TrialState.COMPLETE,
+        optuna.trial.TrialState.PRUNED,
+        optuna.trial.TrialState.FAIL
+    ]
+
+    def __init__(self, config, study_name, bins_folder, backup_folder, ledger=None):
+        self.ledger = ledger
+        self.top_k = config.retention_top_k
+        self.compress = config.retention_compress
+        self.quota_bytes = config.retention_quota_mb * 1024 * 1024
+        self.use_best_param = config.use_best_param
+        self.bins_folder = Path(bins_folder)
+        self.backup_folder = Path(backup_folder)
+        self.net_pattern = re.compile(r'^(\d+)_nn\.bin(\.gz)?$')
+        self.positions_pattern = re.compile(
+            rf'^{re.escape(study_name)}_(training|validation)_trial_(\d+)_.*\.(bin|binpack)(\.gz)?$')
+
+    def enabled(self):
+        return self.top_k > 0 or self.quota_bytes > 0
+
+    def get_artifacts(self):
+        """
+        Returns {trial number: [files]} of the nets and the positions.
+        """
+        artifacts = {}
+        for folder, pattern, group in [(self.bins_folder, self.net_pattern, 1),
+                                       (self.backup_folder, self.positions_pattern, 2)]:
+            if not folder.is_dir():
+                continue
+            for fn in folder.iterdir():
+                m = pattern.match(fn.name)
+                if m is not None:
+                    artifacts.setdefault(int(m.group(group)), []).append(fn)
+        return artifacts
+
+    def get_strengths(self, trials):
+        """
+        Returns {trial number: strength} of the trials. The elo user attr of a trial is
+        from the matches before it was told, the elo from the ledger is used when its net
+        has played.
+        """
+        strengths = {t.number: get_strength(t) for t in trials}
+        if self.ledger is None:
+            return strengths
+        ratings = fit_ratings(self.ledger.entries())
+        for t in trials:
+            fn = Path(self.bins_folder, f'{t.number}_nn.bin')
+            rating = ratings.get(get_file_digest(fn)) if fn.is_file() else None
+            if rating is not None:
+                strengths[t.number] = rating[0]
+        return strengths
+
+    def get_opponents(self, all_trials, strengths):
+        """
+        Returns the trials whose net can be the opponent in a match, the best trial and
+        the trials that were the best since the start of the oldest running trial, as
+        their match may still be played by another worker.
+        """
+        running = [t.datetime_start for t in all_trials
+                   if t.state == optuna.trial.TrialState.RUNNING and t.datetime_start is not None]
+        since = min(running) if len(running) else None
+
+        completed = [t for t in all_trials if t.state == optuna.trial.TrialState.COMPLETE]
+        opponents, best = set(), None
+        for t in sorted(completed, key=lambda t: t.datetime_complete):
+            if best is None or strengths[t.number] > strengths[best.number]:
+                if best is not None and since is not None and t.datetime_complete > since:
+                    opponents.add(best.number)
+                best = t
+        if best is not None:
+            opponents.add(best.number)
+        return opponents
+
+    def apply(self, study):
+        if not self.enabled():
+            return
+
+        all_trials = study.get_trials(deepcopy=False)
+        trials = [t for t in all_trials if t.state in self.FINISHED_STATES]
+        strengths = self.get_strengths(trials)
+
+        # Best trials first, trials without a value are the worst.
+        ranked = sorted(trials, key=lambda t: (t.state == optuna.trial.TrialState.COMPLETE,
+                                               strengths[t.number]),
+                        reverse=True)
+        ranked = [t.number for t in ranked]
+
+        protected = self.get_opponents(all_trials, strengths)
+        if not self.use_best_param:
+            protected.add(0)
+
+        artifacts = self.get_artifacts()
+
+        # Compress or delete the artifacts of the trials that are not in the top k.
+        if self.top_k > 0:
+            for number in ranked[self.top_k:]:
+                if number in protected:
+                    continue
+                for fn in artifacts.get(number, []):
+                    if self.compress and fn.suffix != '.gz':
+                        if is_linked(fn):
+                            continue
+                        compress_file(fn)
+                        logger.debug(f'retention, compressed {fn.name}')
+                    elif not self.compress:
+                        fn.unlink(missing_ok=True)
+                        logger.debug(f'retention, deleted {fn.name}')
+            artifacts = self.get_artifacts()
+
+        # Delete the artifacts of the worst trials until the quota is met.
+        if self.quota_bytes > 0:
+            sizes = {}
+            for number, files in artifacts.items():
+                sizes[number] = sum(fn.stat().st_size for fn in files
+                                    if fn.is_file() and not is_linked(fn))
+            total = sum(sizes.values())
+            for number in reversed(ranked):
+                if total <= self.quota_bytes:
+                    break
+                if number in protected or number not in artifacts:
+                    continue
+                for fn in artifacts[number]:
+                    fn.unlink(missing_ok=True)
+                total -= sizes[number]
+                logger.debug(f'retention, deleted the artifacts of trial {number}, quota exceeded')
 
-def create_folder(folder):
-    new_folder = Path(folder)
-    new_folder.mkdir(exist_ok=True)
 
+def is_linked(fn):
+    """
+    Returns True if the file has other hard links, deleting it frees no space.
+    """
+    try:
+        return Path(fn).stat().st_nlink > 1
+    except OSError:
+        return False
 
-def move_data(src, dst):
-    shutil.move(src, dst)
 
+def compress_file(fn):
+    """
+    Replaces the file by its gzip file.
+    """
+    fn = Path(fn)
+    dst = fn.with_name(f'{fn.name}.gz')
+    tmp = fn.with_name(f'{fn.name}.gz.{os.getpid()}.tmp')
+    with open(fn, 'rb') as f, gzip.open(tmp, 'wb', compresslevel=6) as out:
+        shutil.copyfileobj(f, out, 1 << 20)
+    os.replace(tmp, dst)
+    fn.unlink(missing_ok=True)
 
-def get_sampler(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('OPTUNA'))
-    return data.get('sampler', 'tpe')
 
+_file_digests = {}
 
-def get_study_name(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('OPTUNA'))
-    return data.get('study_name', None)
 
+def get_file_digest(fn):
+    """
+    Returns the sha256 of the file. The digest is computed only once for the same file
+    path, size and modification time.
+    """
+    path = Path(fn).resolve()
+    st = path.stat()
+    stamp = (str(path), st.st_size, st.st_mtime_ns)
+    if stamp not in _file_digests:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _file_digests[stamp] = h.hexdigest()
+    return _file_digests[stamp]
+
+
+def link_or_copy(src, dst):
+    """
+    Hard links src to dst, the file is copied if the link cannot be created like when
+    they are on different drives.
+    """
+    try:
+        os.link(src, dst)
+    except FileNotFoundError:
+        # There is no src to copy.
+        raise
+    except OSError:
+        shutil.copy2(src, dst)
 
-def get_study_num_trials(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('OPTUNA'))
-    return int(data.get('num_trials', 100))
 
+def retry_on_error(func, *args, attempts=6, delay=0.05):
+    """
+    Calls func and retries with backoff when it fails with OSError, like when a file is
+    still open by the engine on Windows. A missing file is not retried.
+    """
+    for i in range(attempts):
+        try:
+            return func(*args)
+        except FileNotFoundError:
+            raise
+        except OSError as err:
+            if i == attempts - 1:
+                raise
+            logger.debug(f'{func.__name__} failed, retrying, as {err}')
+            time.sleep(delay * 2 ** i)
 
-def get_engine_file(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('ENGINE'))
-    return data.get('engine_file', None)
 
+def wait_for_file(fn, timeout=30.0):
+    """
+    Waits until the file is complete, its size does not change and it can be opened for
+    writing which fails on Windows while the engine still writes it. Returns the size.
+    """
+    deadline = time.monotonic() + timeout
+    delay, last_size = 0.01, None
+    while True:
+        try:
+            size = os.path.getsize(fn)
+            if size == last_size:
+                with open(fn, 'r+b'):
+                    return size
+            last_size = size
+        except OSError:
+            last_size = None
 
-def get_plot_params(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('PLOT'))
-    opt_value = data.get('plot_params', None)
-    return ast.literal_eval(opt_value)
+        if time.monotonic() > deadline:
+            if not Path(fn).is_file():
+                raise FileNotFoundError(f'{fn} is not found after {timeout}s')
+            raise TimeoutError(f'{fn} is not ready after {timeout}s')
 
+        time.sleep(delay)
+        delay = min(delay * 2, 1.0)
 
-def get_engine_threads(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('ENGINE'))
-    return int(data.get('threads', 1))
 
+def delete_folder(folder: str):
+    folder_path = Path(folder)
+    if folder_path.is_dir():
+        retry_on_error(shutil.rmtree, folder_path)
 
-def get_engine_options(ini_file):
-    options = []
 
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
+def create_folder(folder):
+    new_folder = Path(folder)
+    new_folder.mkdir(exist_ok=True)
 
-    for section_name in parser.sections():
-        for opt_name, opt_value in parser.items(section_name):
-            if section_name == 'ENGINE':
-                options.append({opt_name: opt_value})
 
-    return options
+def replace_file(src, dst):
+    """
+    Renames src to dst in one step. Between drives the file is copied to a temp file
+    first so that dst is never partial.
+    """
+    try:
+        os.replace(src, dst)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        tmp = f'{dst}.{os.getpid()}.tmp'
+        shutil.copy2(src, tmp)
+        os.replace(tmp, dst)
+        os.remove(src)
 
 
-def get_engine_hash_mb(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('ENGINE'))
-    return int(data.get('hash', 128))
+def move_data(src, dst):
+    """
+    Moves the file once it is completely written.
+    """
+    wait_for_file(src)
+    retry_on_error(replace_file, src, dst)
 
 
-def get_depth(ini_file, mode='train'):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    if mode.lower() == 'val':
-        data = dict(parser.items('VALIDATION_POS_GENERATION'))
-        return int(data.get('depth', 0))
-    else:
-        data = dict(parser.items('TRAINING_POS_GENERATION'))
-        return int(data.get('depth', 3))
+def append_line(fn, text):
+    """
+    Appends text as one line to the file with a single write, so that the lines of the
+    workers and hosts that append to the same file are not mixed.
+    """
+    if not text.endswith('\n'):
+        text += '\n'
+    fd = os.open(fn, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, text.encode('utf-8'))
+    finally:
+        os.close(fd)
 
 
-def get_num_positions(ini_file, mode='train'):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    if mode.lower() == 'val':
-        data = dict(parser.items('VALIDATION_POS_GENERATION'))
-        return int(data.get('num_pos', 0))
-    else:
-        data = dict(parser.items('TRAINING_POS_GENERATION'))
-        return int(data.get('num_pos', 8000000000))
+class ParamSpec:
+    """
+    A param to optimize, it is parsed from the ini value only once.
+    categorical: name = [v1, v2, ...]
+    int or float: name = (low, high) or name = (low, high, step)
+    """
+    def __init__(self, section, name, value):
+        self.name = name
 
+        try:
+            n_value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            raise ValueError(f'[{section}] {name} = {value}, is not a list or a tuple') from None
+
+        # categorical variable
+        if isinstance(n_value, list):
+            if len(n_value) == 0:
+                raise ValueError(f'[{section}] {name} = {value}, there are no choices')
+            self.kind = 'categorical'
+            self.choices = n_value
+            return
+
+        # continuous variable
+        if not isinstance(n_value, tuple) or len(n_value) not in [2, 3]:
+            raise ValueError(f'[{section}] {name} = {value}, use (low, high) or (low, high, step)')
+
+        if not all(isinstance(n, (int, float)) and not isinstance(n, bool) for n in n_value):
+            raise ValueError(f'[{section}] {name} = {value}, the range values should be numbers')
+
+        self.kind = 'int' if all(isinstance(n, int) for n in n_value) else 'float'
+        self.low, self.high = n_value[0], n_value[1]
+        self.step = n_value[2] if len(n_value) == 3 else None
+
+        if self.low >= self.high:
+            raise ValueError(f'[{section}] {name} = {value}, low should be less than high')
+        if self.step is not None and self.step <= 0:
+            raise ValueError(f'[{section}] {name} = {value}, step should be more than 0')
+
+    def suggest(self, trial):
+        """
+        Asks the optimizer the value to try.
+        """
+        if self.kind == 'categorical':
+            return trial.suggest_categorical(self.name, self.choices)
+        if self.kind == 'int':
+            return trial.suggest_int(self.name, self.low, self.high, step=self.step or 1)
+        return trial.suggest_float(self.name, self.low, self.high, step=self.step)
 
-def get_validation_count(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('LEARNING'))
-    return int(data.get('validation_count', 2000))
-
-
-def get_book(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('TRAINING_POS_GENERATION'))
-    return data.get('book', None)
-
-
-def get_cutechess_rounds(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('CUTECHESS'))
-    return int(data.get('rounds', 50))
-
-
-def get_cutechess_concurrency(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('CUTECHESS'))
-    return int(data.get('concurrency', 1))
-
-
-def get_cutechess_draw(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('CUTECHESS'))
-    return data.get('draw', None)
-
-
-def get_cutechess_resign(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('CUTECHESS'))
-    return data.get('resign', None)
-
-
-def get_python_file(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('CUTECHESS'))
-    return data.get('python_file', 'python')
 
+class StudyConfig:
+    """
+    The settings of the study. The ini file is parsed and validated once at startup.
+    """
+    # Known options of the sections that are not passed to the engine.
+    KNOWN_OPTIONS = {
+        'MABIGAT': [
+            'use_best_param', 'init_best_match_result', 'workers', 'cores', 'artifact_dir',
+            'val_cache', 'val_cache_dir', 'val_cache_quota_mb', 'val_copy_training_param', 'reuse_training_data',
+            'training_data_store_quota_mb', 'pipeline', 'pipeline_gen_cores',
+            'engine_ready_timeout', 'engine_stall_timeout', 'gensfen_shards',
+            'dedup_training_data', 'shuffle_training_data', 'training_data_memory_mb',
+            'retention_top_k', 'retention_compress', 'retention_quota_mb', 'trial_log_parquet',
+            'status_port', 'resume_trials', 'opponent_wait_timeout'
+        ],
+        'OPTUNA': [
+            'study_name', 'num_trials', 'sampler', 'storage', 'pruner', 'pruner_startup_trials',
+            'pruner_warmup_steps', 'pruner_percentile', 'learn_report_interval',
+            'match_report_interval', 'fidelity_rungs', 'fidelity_reduction_factor', 'objective'
+        ],
+        'CUTECHESS': [
+            'python_file', 'cutechess_cli_path', 'rounds', 'time_control', 'book', 'concurrency',
+            'draw', 'resign', 'sprt', 'elo0', 'elo1', 'alpha', 'beta'
+        ],
+        'PLOT': ['plot_params', 'learning_plot_interval', 'report_interval']
+    }
+
+    SAMPLERS = ['tpe', 'cmaes']
+    PRUNERS = ['none', 'median', 'percentile', 'halving', 'hyperband']
+    OBJECTIVES = ['score', 'score_per_hour', 'pareto', 'elo']
+
+    def __init__(self, ini_file, check_files=True):
+        self.ini_file = ini_file
 
-def get_cutechess_book(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('CUTECHESS'))
-    return data.get('book', '')
+        # The engine file is not needed to only read the study like with the report command.
+        self.check_files = check_files
 
+        parser = configparser.ConfigParser()
+        if not parser.read(ini_file):
+            raise ValueError(f'ini file {ini_file} cannot be read')
 
-def get_eval_save_interval(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('LEARNING'))
-    return int(data.get('eval_save_interval', 100000000))
+        self.check_options(parser)
 
+        def get(section, option, fallback=None):
+            return parser.get(section, option, fallback=fallback)
 
-def get_loss_output_interval(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('LEARNING'))
-    return int(data.get('loss_output_interval', 1000000))
+        def get_number(section, option, fallback, number_type=int):
+            value = parser.get(section, option, fallback=None)
+            if value is None:
+                return fallback
+            try:
+                return number_type(value)
+            except ValueError:
+                raise ValueError(f'[{section}] {option} = {value}, is not a valid {number_type.__name__}') from None
+
+        # --- mabigat ---
+        self.use_best_param = get_number('MABIGAT', 'use_best_param', 1)
+        self.init_best_match_result = get_number('MABIGAT', 'init_best_match_result', 0.5, float)
+        self.workers = get_number('MABIGAT', 'workers', 1)
+        self.cores = get_number('MABIGAT', 'cores', 0)
+        if self.cores <= 0:
+            self.cores = os.cpu_count() or 1
+        self.artifact_dir = get('MABIGAT', 'artifact_dir', '')
+        self.val_cache = get_number('MABIGAT', 'val_cache', 0)
+        self.val_cache_dir = get('MABIGAT', 'val_cache_dir', './study/val_cache')
+        self.val_cache_quota_mb = get_number('MABIGAT', 'val_cache_quota_mb', 10000)
+        self.val_copy_training_param = get_number('MABIGAT', 'val_copy_training_param', 1)
+        self.reuse_training_data = get_number('MABIGAT', 'reuse_training_data', 0)
+        self.training_data_store_quota_mb = get_number('MABIGAT', 'training_data_store_quota_mb', 0)
+        self.pipeline = get_number('MABIGAT', 'pipeline', 0)
+        self.pipeline_gen_cores = get_number('MABIGAT', 'pipeline_gen_cores', 0)
+        self.engine_ready_timeout = get_number('MABIGAT', 'engine_ready_timeout', 120.0, float)
+        self.engine_stall_timeout = get_number('MABIGAT', 'engine_stall_timeout', 1800.0, float)
+        self.gensfen_shards = get_number('MABIGAT', 'gensfen_shards', 1)
+        self.dedup_training_data = get_number('MABIGAT', 'dedup_training_data', 0)
+        self.shuffle_training_data = get_number('MABIGAT', 'shuffle_training_data', 0)
+        self.training_data_memory_mb = get_number('MABIGAT', 'training_data_memory_mb', 1024)
+        self.retention_top_k = get_number('MABIGAT', 'retention_top_k', 0)
+        self.retention_compress = get_number('MABIGAT', 'retention_compress', 0)
+        self.retention_quota_mb = get_number('MABIGAT', 'retention_quota_mb', 0)
+        self.trial_log_parquet = get_number('MABIGAT', 'trial_log_parquet', 0)
+        self.status_port = get_number('MABIGAT', 'status_port', 0)
+        self.resume_trials = get_number('MABIGAT', 'resume_trials', 2)
+        self.opponent_wait_timeout = get_number('MABIGAT', 'opponent_wait_timeout', 3600)
+
+        # --- optuna ---
+        self.study_name = get('OPTUNA', 'study_name')
+        self.num_trials = get_number('OPTUNA', 'num_trials', 100)
+        self.sampler = get('OPTUNA', 'sampler', 'tpe').lower()
+        self.objective = get('OPTUNA', 'objective', 'score').lower()
+        self.storage = get('OPTUNA', 'storage', '')
+        self.pruner = get('OPTUNA', 'pruner', 'none').lower()
+        self.pruner_startup_trials = get_number('OPTUNA', 'pruner_startup_trials', 5)
+        self.pruner_warmup_steps = get_number('OPTUNA', 'pruner_warmup_steps', 0)
+        self.pruner_percentile = get_number('OPTUNA', 'pruner_percentile', 25.0, float)
+        self.learn_report_interval = get_number('OPTUNA', 'learn_report_interval', 1)
+        self.match_report_interval = get_number('OPTUNA', 'match_report_interval', 20)
+        self.fidelity_rungs = get_number('OPTUNA', 'fidelity_rungs', 1)
+        self.fidelity_reduction_factor = get_number('OPTUNA', 'fidelity_reduction_factor', 3)
+
+        # --- engine ---
+        self.engine_file = get('ENGINE', 'engine_file')
+        self.threads = get_number('ENGINE', 'threads', 1)
+        self.hash_mb = get_number('ENGINE', 'hash', 128)
+        self.engine_options = self.get_section_param(parser, 'ENGINE')
+
+        # --- cutechess ---
+        self.python_file = get('CUTECHESS', 'python_file', 'python')
+        self.cutechess_cli_path = get('CUTECHESS', 'cutechess_cli_path', './cutechess/cutechess-cli.exe')
+        self.rounds = get_number('CUTECHESS', 'rounds', 50)
+        self.time_control = get('CUTECHESS', 'time_control', '0/2+0.05')
+        self.cutechess_book = get('CUTECHESS', 'book', '')
+        self.concurrency = get_number('CUTECHESS', 'concurrency', 1)
+        self.draw = get('CUTECHESS', 'draw')
+        self.resign = get('CUTECHESS', 'resign')
+        self.sprt = None
+        if get_number('CUTECHESS', 'sprt', 0):
+            self.sprt = (get_number('CUTECHESS', 'elo0', 0.0, float), get_number('CUTECHESS', 'elo1', 10.0, float),
+                         get_number('CUTECHESS', 'alpha', 0.05, float), get_number('CUTECHESS', 'beta', 0.05, float))
+
+        # --- training / validation ---
+        self.numpos_train = get_number('TRAINING_POS_GENERATION', 'num_pos', 8000000000)
+        self.train_depth = get_number('TRAINING_POS_GENERATION', 'depth', 3)
+        self.book = get('TRAINING_POS_GENERATION', 'book')
+        self.numpos_val = get_number('VALIDATION_POS_GENERATION', 'num_pos', 0)
+        self.val_depth = get_number('VALIDATION_POS_GENERATION', 'depth', 0)
+
+        # These params are not to be optimized but changed by user probably to
+        # be different from its default values.
+        self.training_gen_param = self.get_section_param(parser, 'TRAINING_POS_GENERATION')
+        self.validation_gen_param = self.get_section_param(parser, 'VALIDATION_POS_GENERATION')
+        self.learning_param = self.get_section_param(parser, 'LEARNING')
+
+        # Positions are only removed and shuffled one by one in bin files, in binpack
+        # files only whole chunks are, so gensfen writes bin files for these options.
+        if (self.dedup_training_data or self.shuffle_training_data) \
+                and get_param_value(self.training_gen_param, 'sfen_format') is None:
+            self.training_gen_param.append({'sfen_format': 'bin'})
+        self.sfen_format = get_param_value(self.training_gen_param, 'sfen_format') or 'binpack'
+
+        # --- learning ---
+        self.validation_count = get_number('LEARNING', 'validation_count', 2000)
+        self.eval_save_interval = get_number('LEARNING', 'eval_save_interval', 100000000)
+        self.loss_output_interval = get_number('LEARNING', 'loss_output_interval', 1000000)
+
+        # --- params to optimize ---
+        self.training_gen_space = self.get_search_space(parser, 'TRAINING_POS_GENERATION_PARAM_TO_OPTIMIZE')
+        self.validation_gen_space = self.get_search_space(parser, 'VALIDATION_POS_GENERATION_PARAM_TO_OPTIMIZE')
+        self.learning_space = self.get_search_space(parser, 'LEARNING_PARAM_TO_OPTIMIZE')
+
+        # --- plot ---
+        plot_params = get('PLOT', 'plot_params')
+        self.plot_params = None
+        if plot_params is not None:
+            try:
+                self.plot_params = ast.literal_eval(plot_params)
+            except (ValueError, SyntaxError):
+                raise ValueError(f'[PLOT] plot_params = {plot_params}, is not a list') from None
+        self.learning_plot_interval = get_number('PLOT', 'learning_plot_interval', 30.0, float)
+        self.report_interval = get_number('PLOT', 'report_interval', 60.0, float)
 
+        self.validate()
 
-def get_use_best_param(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('MABIGAT'))
-    return int(data.get('use_best_param', 1))
+    def check_options(self, parser):
+        """
+        Options that are not passed to the engine should be known, a typo is an error.
+        """
+        for section, known in self.KNOWN_OPTIONS.items():
+            if not parser.has_section(section):
+                continue
+            for option in parser.options(section):
+                if option not in known:
+                    raise ValueError(f'[{section}] {option} is not a known option')
+
+    @staticmethod
+    def get_section_param(parser, section):
+        """
+        Returns the options of the section as a list of dict.
+        """
+        if not parser.has_section(section):
+            return []
+        return [{opt_name: opt_value} for opt_name, opt_value in parser.items(section)]
+
+    @staticmethod
+    def get_search_space(parser, section):
+        if not parser.has_section(section):
+            return []
+        return [ParamSpec(section, opt_name, opt_value) for opt_name, opt_value in parser.items(section)]
+
+    def validate(self):
+        if self.study_name is None:
+            raise ValueError('define study_name under OPTUNA section')
+        if ' ' in self.study_name:
+            raise ValueError(f'[OPTUNA] study_name = {self.study_name}, do not use a name with space')
+        if self.engine_file is None:
+            raise ValueError('define engine_file under ENGINE section, engine_file = path/toyourenginefile/eng.exe')
+        if self.check_files and not Path(self.engine_file).is_file():
+            raise ValueError(f'[ENGINE] engine_file = {self.engine_file}, file does not exist')
+        if self.sampler not in self.SAMPLERS:
+            raise ValueError(f'[OPTUNA] sampler = {self.sampler}, use one of {self.SAMPLERS}')
+        if self.pruner not in self.PRUNERS:
+            raise ValueError(f'[OPTUNA] pruner = {self.pruner}, use one of {self.PRUNERS}')
+
+        for section, option, value, low in [
+                ('MABIGAT', 'workers', self.workers, 1),
+                ('MABIGAT', 'val_cache_quota_mb', self.val_cache_quota_mb, 0),
+                ('MABIGAT', 'training_data_store_quota_mb', self.training_data_store_quota_mb, 0),
+                ('MABIGAT', 'pipeline_gen_cores', self.pipeline_gen_cores, 0),
+                ('MABIGAT', 'engine_ready_timeout', self.engine_ready_timeout, 0),
+                ('MABIGAT', 'engine_stall_timeout', self.engine_stall_timeout, 0),
+                ('MABIGAT', 'gensfen_shards', self.gensfen_shards, 1),
+                ('MABIGAT', 'training_data_memory_mb', self.training_data_memory_mb, 1),
+                ('MABIGAT', 'retention_top_k', self.retention_top_k, 0),
+                ('MABIGAT', 'retention_quota_mb', self.retention_quota_mb, 0),
+                ('MABIGAT', 'opponent_wait_timeout', self.opponent_wait_timeout, 0),
+                ('OPTUNA', 'num_trials', self.num_trials, 0),
+                ('OPTUNA', 'learn_report_interval', self.learn_report_interval, 0),
+                ('OPTUNA', 'match_report_interval', self.match_report_interval, 0),
+                ('OPTUNA', 'fidelity_rungs', self.fidelity_rungs, 1),
+                ('OPTUNA', 'fidelity_reduction_factor', self.fidelity_reduction_factor, 2),
+                ('ENGINE', 'threads', self.threads, 1),
+                ('CUTECHESS', 'rounds', self.rounds, 1),
+                ('CUTECHESS', 'concurrency', self.concurrency, 1),
+                ('TRAINING_POS_GENERATION', 'num_pos', self.numpos_train, 1),
+                ('VALIDATION_POS_GENERATION', 'num_pos', self.numpos_val, 0),
+                ('VALIDATION_POS_GENERATION', 'depth', self.val_depth, 0)]:
+            if value < low:
+                raise ValueError(f'[{section}] {option} = {value}, should be at least {low}')
+
+        if self.objective not in self.OBJECTIVES:
+            raise ValueError(f'[OPTUNA] objective = {self.objective}, use one of {self.OBJECTIVES}')
+
+        # Optuna does not prune trials of a study with several objectives.
+        if self.objective == 'pareto' and (self.pruner != 'none' or self.fidelity_rungs > 1):
+            raise ValueError('[OPTUNA] objective = pareto, use pruner = none and fidelity_rungs = 1')
+
+        if self.fidelity_rungs > 1 and self.pruner == 'none':
+            raise ValueError(f'[OPTUNA] fidelity_rungs = {self.fidelity_rungs}, needs a pruner like hyperband')
+
+        # The positions of every rung are a part of num_pos.
+        if self.fidelity_rungs > 1 and get_param_value(self.training_gen_param, 'num_pos') is None \
+                and 'num_pos' not in [p.name.lower() for p in self.training_gen_space]:
+            raise ValueError(f'[OPTUNA] fidelity_rungs = {self.fidelity_rungs}, needs num_pos in [TRAINING_POS_GENERATION]')
+
+        if not 0 <= self.status_port <= 65535:
+            raise ValueError(f'[MABIGAT] status_port = {self.status_port}, should be from 0 to 65535')
+
+        if self.resume_trials < 0:
+            raise ValueError(f'[MABIGAT] resume_trials = {self.resume_trials}, should be 0 or more')
+
+        if not 0 <= self.init_best_match_result <= 1:
+            raise ValueError(f'[MABIGAT] init_best_match_result = {self.init_best_match_result}, should be from 0 to 1')
+
+        if self.sprt is not None:
+            elo0, elo1, alpha, beta = self.sprt
+            if elo0 >= elo1:
+                raise ValueError(f'[CUTECHESS] elo0 = {elo0}, should be less than elo1 = {elo1}')
+            if not (0 < alpha < 1 and 0 < beta < 1):
+                raise ValueError(f'[CUTECHESS] alpha = {alpha}, beta = {beta}, should be between 0 and 1')
+
+        if (self.dedup_training_data or self.shuffle_training_data) and self.sfen_format != 'bin':
+            raise ValueError(f'[TRAINING_POS_GENERATION] sfen_format = {self.sfen_format}, dedup_training_data '
+                             f'and shuffle_training_data need bin, remove sfen_format')
+
+        # The validation positions need a depth that is not taken from the training params.
+        if not self.val_copy_training_param and self.val_depth == 0 \
+                and 'depth' not in [p.name for p in self.validation_gen_space]:
+            raise ValueError('[MABIGAT] val_copy_training_param = 0, set [VALIDATION_POS_GENERATION] depth')
+
+        if self.plot_params is not None:
+            names = self.get_param_names()
+            for name in self.plot_params:
+                if name not in names:
+                    raise ValueError(f'[PLOT] plot_params, {name} is not a param to optimize')
+
+    def get_param_names(self):
+        """
+        Returns the names of the params to optimize.
+        """
+        names = [p.name for p in self.training_gen_space + self.validation_gen_space + self.learning_space]
+        return list(dict.fromkeys(names))
 
+    def suggest(self, trial, space, stage):
+        """
+        Asks the optimizer the param values to try, returns a list of dict.
+        """
+        param = []
+        for spec in space:
+            var = spec.suggest(trial)
+            logger.info(f'stage: {stage}, param to optimize: {spec.name}, value: {var}')
+            param.append({spec.name: var})
+        return param
+
+    def get_storage(self, sub_study_folder):
+        """
+        Returns the storage url of the study. Hosts that share a study should use the same
+        storage, like a journal file in a shared folder, journal:/shared/study.journal.
+        """
+        if self.storage == '':
+            return f'sqlite:///{sub_study_folder}/{self.study_name}.db'
+        if self.storage.lower() == 'journal':
+            return f'journal:{sub_study_folder}/{self.study_name}.journal'
+        return self.storage
 
-def get_init_best_match_result(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('MABIGAT'))
-    return float(data.get('init_best_match_result', 0.5))
+    def get_artifact_dir(self, sub_study_folder):
+        """
+        Returns the folder where the nets are published. Hosts that share a study should
+        use a shared folder so that every host can find the net of the best trial.
+        """
+        if self.artifact_dir == '':
+            return Path(sub_study_folder)
+        return Path(self.artifact_dir)
 
+    def get_pipeline_gen_cores(self, worker_cores):
+        """
+        Returns the cores reserved for the generation of positions in pipeline mode, 0 means
+        half of the worker cores.
+        """
+        gen_cores = self.pipeline_gen_cores
+        if gen_cores <= 0:
+            gen_cores = worker_cores // 2
+        return max(1, min(gen_cores, worker_cores - 1))
 
-def get_cutechess_cli_path(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('CUTECHESS'))
-    return data.get('cutechess_cli_path', './cutechess/cutechess-cli.exe')
-
-
-def get_cutechess_time_control(ini_file):
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-    data = dict(parser.items('CUTECHESS'))
-    return data.get('time_control', '0/2+0.05')
-
-
-def get_training_gen_param_to_optimize(ini_file, trial):
-    """
-    Asks the optimizer the param values to try.
-    """
-    training_gen_param_to_optimize = []
-    stage = 'pos gen for training'
-
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-
-    for section_name in parser.sections():
-        for opt_name, opt_value in parser.items(section_name):
-            if section_name == 'TRAINING_POS_GENERATION_PARAM_TO_OPTIMIZE':
-                # categorical variable
-                if '[' in opt_value and ']' in opt_value:
-                    n_value = ast.literal_eval(opt_value)
-                    var = trial.suggest_categorical(opt_name, n_value)
-                    logger.info(f'stage: {stage}, param to optimize: {opt_name}, value: {var}')
-                    training_gen_param_to_optimize.append({opt_name: var})
+    def create_pruner(self):
+        """
+        Returns the optuna pruner that can stop a trial with poor learning or partial match results.
+        """
+        # https://optuna.readthedocs.io/en/stable/reference/pruners.html
+        if self.pruner == 'median':
+            return optuna.pruners.MedianPruner(n_startup_trials=self.pruner_startup_trials,
+                                               n_warmup_steps=self.pruner_warmup_steps)
+        if self.pruner == 'percentile':
+            return optuna.pruners.PercentilePruner(self.pruner_percentile,
+                                                   n_startup_trials=self.pruner_startup_trials,
+                                                   n_warmup_steps=self.pruner_warmup_steps)
+        if self.pruner == 'halving':
+            if self.fidelity_rungs > 1:
+                return optuna.pruners.SuccessiveHalvingPruner(
+                    min_resource=1, reduction_factor=self.fidelity_reduction_factor)
+            return optuna.pruners.SuccessiveHalvingPruner()
+        if self.pruner == 'hyperband':
+            max_resource = self.get_rung_step(self.fidelity_rungs - 1) if self.fidelity_rungs > 1 else 'auto'
+            return optuna.pruners.HyperbandPruner(
+                min_resource=1, max_resource=max_resource,
+                reduction_factor=self.fidelity_reduction_factor)
+        return optuna.pruners.NopPruner()
+
+    def get_directions(self):
+        """
+        Returns the directions of the study, the pareto objective maximizes the match score
+        and minimizes the core hours.
+        """
+        if self.objective == 'pareto':
+            return ['maximize', 'minimize']
+        return ['maximize']
 
-                # continuous variable
-                elif '(' in opt_value and ')' in opt_value:
-                    n_value = ast.literal_eval(opt_value)
+    def get_budgets(self):
+        """
+        Returns the fraction of num_pos and rounds of every fidelity rung, the last rung is
+        the full budget. With fidelity_rungs = 3 and fidelity_reduction_factor = 3 it is
+        [1/9, 1/3, 1].
+        """
+        rungs, factor = self.fidelity_rungs, self.fidelity_reduction_factor
+        return [factor ** -(rungs - 1 - k) for k in range(rungs)]
 
-                    if isinstance(n_value[0], float):
-                        if len(n_value) == 3:
-                            (min, high, step) = n_value
-                            var = trial.suggest_float(opt_name, min, high, step=step)
-                            logger.info(f'stage: {stage}, param to optimize: {opt_name}, value: {var}')
-                            training_gen_param_to_optimize.append({opt_name: var})
-                        elif len(n_value) == 2:
-                            (min, high) = n_value
-                            var = trial.suggest_float(opt_name, min, high)
-                            logger.info(f'stage: {stage}, param to optimize: {opt_name}, value: {var}')
-                            training_gen_param_to_optimize.append({opt_name: var})
+    def get_rung_step(self, rung):
+        """
+        Returns the step of the fidelity rung for the pruner, the resource of the rung in
+        units of the first rung, 1, factor, factor**2, ... like the promotion steps of the
+        halving and hyperband pruners with min_resource = 1.
+        """
+        return self.fidelity_reduction_factor ** rung
 
-                    elif isinstance(n_value[0], int):
-                        if len(n_value) == 3:
-                            (min, high, step) = n_value
-                            var = trial.suggest_int(opt_name, min, high, step)
-                            logger.info(f'stage: {stage}, param to optimize: {opt_name}, value: {var}')
-                            training_gen_param_to_optimize.append({opt_name: var})
-                        elif len(n_value) == 2:
-                            (min, high) = n_value
-                            var = trial.suggest_int(opt_name, min, high)
-                            logger.info(f'stage: {stage}, param to optimize: {opt_name}, value: {var}')
-                            training_gen_param_to_optimize.append({opt_name: var})
+    def get_rounds(self, budget):
+        return max(1, round(self.rounds * budget))
 
-    return training_gen_param_to_optimize
+    def get_sprt(self):
+        """
+        Returns the sequential test param as elo0,elo1,alpha,beta or None if the match plays
+        all the rounds.
+        """
+        if self.sprt is None:
+            return None
+        return ','.join(str(n) for n in self.sprt)
 
 
-def get_validation_gen_param_to_optimize(ini_file, trial):
+class SFLogTailer:
     """
-    Asks the optimizer the param values to try.
+    Reads the sflog from where it stopped the last time and keeps the learning values
+    parsed so far, so that a long learning log is only read once.
     """
-    validation_gen_param_to_optimize = []
-    stage = 'pos gen for validation'
-
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-
-    for section_name in parser.sections():
-        for opt_name, opt_value in parser.items(section_name):
-            if section_name == 'VALIDATION_POS_GENERATION_PARAM_TO_OPTIMIZE':
-                # categorical variable
-                if '[' in opt_value and ']' in opt_value:
-                    n_value = ast.literal_eval(opt_value)
-                    var = trial.suggest_categorical(opt_name, n_value)
-                    logger.info(f'stage: {stage}, param to optimize: {opt_name}, value: {var}')
-                    validation_gen_param_to_optimize.append({opt_name: var})
-
-                # continuous variable
-                elif '(' in opt_value and ')' in opt_value:
-                    n_value = ast.literal_eval(opt_value)
-
-                    if isinstance(n_value[0], float):
-                        if len(n_value) == 3:
-                            (min, high, step) = n_value
-                            var = trial.suggest_float(opt_name, min, high, step=step)
-                            logger.info(f'stage: {stage}, param to optimize: {opt_name}, value: {var}')
-                            validation_gen_param_to_optimize.append({opt_name: var})
-                        elif len(n_value) == 2:
-                            (min, high) = n_value
-                            var = trial.suggest_float(opt_name, min, high)
-                            logger.info(f'stage: {stage}, param to optimize: {opt_name}, value: {var}')
-                            validation_gen_param_to_optimize.append({opt_name: var})
-
-                    elif isinstance(n_value[0], int):
-                        if len(n_value) == 3:
-                            (min, high, step) = n_value
-                            var = trial.suggest_int(opt_name, min, high, step)
-                            logger.info(f'stage: {stage}, param to optimize: {opt_name}, value: {var}')
-                            validation_gen_param_to_optimize.append({opt_name: var})
-                        elif len(n_value) == 2:
-                            (min, high) = n_value
-                            var = trial.suggest_int(opt_name, min, high)
-                            logger.info(f'stage: {stage}, param to optimize: {opt_name}, value: {var}')
-                            validation_gen_param_to_optimize.append({opt_name: var})
+    def __init__(self, sflog):
+        self.sflog = sflog
+        self.offset = 0
+        self.partial_line = b''
+        self.val_loss, self.train_loss, self.sfens = [], [], []
+        self.epochs, self.lr, self.move_acc = [], [], []
+
+    def update(self):
+        """
+        Parses the lines added to the sflog since the last update.
+        """
+        try:
+            with open(self.sflog, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        self.offset += len(data)
+        lines = (self.partial_line + data).split(b'\n')
+
+        # The last line is not complete yet, it is parsed in the next update.
+        self.partial_line = lines.pop()
+
+        for line in lines:
+            self.parse_line(line.decode(errors='replace').rstrip())
+
+    def parse_line(self, line):
+        # PROGRESS (calc_loss): Sun Mar 28 01:20:13 2021, 1000000 sfens, 37313 sfens/second, epoch 1
+        if 'PROGRESS' in line:
+            # Get sfens
+            value = int(line.split(' sfens')[0].split(', ')[1])
+            self.sfens.append(value)
+
+            # Get epoch
+            value = int(line.split('epoch ')[1])
+            self.epochs.append(value)
+
+        # - learning rate = 1
+        elif 'learning rate = ' in line:
+            value = float(line.split('learning rate = ')[1])
+            self.lr.append(value)
+
+        # val_loss       = 0.0782639
+        elif 'val_loss' in line:
+            value = float(line.split('= ')[1])
+            self.val_loss.append(value)
+
+        # train_loss = 0.201731
+        elif 'train_loss' in line:
+            value = float(line.split('= ')[1])
+            self.train_loss.append(value)
+
+        # - move accuracy = 0.4875%
+        elif 'move accuracy = ' in line and not 'random move accuracy = ' in line:
+            value = float(line.split('move accuracy = ')[1].split('%')[0])
+            self.move_acc.append(value)
+
+    def series(self):
+        """
+        Returns val_loss, train_loss, sfens, epochs, lr and move_acc parsed so far.
+        """
+        train_loss = list(self.train_loss)
 
-    return validation_gen_param_to_optimize
-
-
-def get_training_gen_param(ini_file):
-    """
-    These params are not to be optimized but changed by user probably to
-    be different from its default values.
-    """
-    param = []
-
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-
-    for section_name in parser.sections():
-        for opt_name, opt_value in parser.items(section_name):
-            if section_name == 'TRAINING_POS_GENERATION':
-                param.append({opt_name: opt_value})
+        # In the beginning, there is no train loss, we will insert a value from 2nd epoch.
+        if len(self.val_loss) - len(train_loss) == 1:
+            if len(train_loss):
+                value_to_insert = train_loss[0]
+                train_loss.insert(0, value_to_insert)
 
-    return param
+        return (list(self.val_loss), train_loss, list(self.sfens), list(self.epochs),
+                list(self.lr), list(self.move_acc))
 
 
-def get_validation_gen_param(ini_file):
+def plot_val_train_loss(sflog):
     """
-    These params are not to be optimized but changed by user probably to
-    be different from its default values.
+    Read the whole sflog and returns its learning values.
     """
-    param = []
-
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-
-    for section_name in parser.sections():
-        for opt_name, opt_value in parser.items(section_name):
-            if section_name == 'VALIDATION_POS_GENERATION':
-                param.append({opt_name: opt_value})
-
-    return param
+    tailer = SFLogTailer(sflog)
+    tailer.update()
+    return tailer.series()
 
 
-def get_learning_param_to_optimize(ini_file, trial):
+def setup_logger(log_filename, prefix=''):
     """
-    Asks the optimizer the param values to try.
+    Logs to file and console. The prefix is used to identify the worker when there are
+    more than one worker writing to the same log file.
     """
-    param = []
-    stage = 'learning'
-
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
-
-    for section_name in parser.sections():
-        for opt_name, opt_value in parser.items(section_name):
-            if section_name == 'LEARNING_PARAM_TO_OPTIMIZE':
-                # categorical variable
-                if '[' in opt_value and ']' in opt_value:
-                    n_value = ast.literal_eval(opt_value)
-                    var = trial.suggest_categorical(opt_name, n_value)
-                    logger.info(f'stage: {stage}, param to optimize: {opt_name}, value: {var}')
-                    param.append({opt_name: var})
+    logger.setLevel(logging.DEBUG)
 
-                # continuous variable
-                elif '(' in opt_value and ')' in opt_value:
-                    n_value = ast.literal_eval(opt_value)
+    fh = logging.FileHandler(filename=log_filename, mode='a')
+    fh.setLevel(logging.DEBUG)
 
-                    if isinstance(n_value[0], float):
-                        if len(n_value) == 3:
-                            (min, high, step) = n_value
-                            var = trial.suggest_float(opt_name, min, high, step=step)
-                            logger.info(f'stage: {stage}, param to optimize: {opt_name}, value: {var}')
-                            param.append({opt_name: var})
-                        elif len(n_value) == 2:
-                            (min, high) = n_value
-                            var = trial.suggest_float(opt_name, min, high)
-                            logger.info(f'stage: {stage}, param to optimize: {opt_name}, value: {var}')
-                            param.append({opt_name: var})
+    ch = logging.StreamHandler(sys.stdout)
+    ch.setLevel(logging.INFO)
 
-                    elif isinstance(n_value[0], int):
-                        if len(n_value) == 3:
-                            (min, high, step) = n_value
-                            var = trial.suggest_int(opt_name, min, high, step)
-                            logger.info(f'stage: {stage}, param to optimize: {opt_name}, value: {var}')
-                            param.append({opt_name: var})
-                        elif len(n_value) == 2:
-                            (min, high) = n_value
-                            var = trial.suggest_int(opt_name, min, high)
-                            logger.info(f'stage: {stage}, param to optimize: {opt_name}, value: {var}')
-                            param.append({opt_name: var})
+    fh_formatter = logging.Formatter(f'{prefix}%(message)s')
+    ch_formatter = logging.Formatter(f'{prefix}%(message)s')
+    fh.setFormatter(fh_formatter)
+    ch.setFormatter(ch_formatter)
 
-    return param
+    logger.addHandler(fh)
+    logger.addHandler(ch)
 
 
-def get_learning_param(ini_file):
+def split_cores(cores, workers):
     """
-    These params are not to be optimized but changed by user probably to
-    be different from its default values.
+    Returns the number of cores a single worker can use. A worker uses all its cores
+    as engine threads during position generation and learning, and as cutechess
+    concurrency during the match.
     """
-    param = []
+    return max(1, cores // max(1, workers))
 
-    parser = configparser.ConfigParser()
-    parser.read(ini_file)
 
-    for section_name in parser.sections():
-        for opt_name, opt_value in parser.items(section_name):
-            if section_name == 'LEARNING':
-                param.append({opt_name: opt_value})
-
-    return param
-
-
-def plot_val_train_loss(sflog):
+def override_engine_option(engine_options, name, value):
     """
-    Always read the sflog from the start.
+    Returns a copy of engine_options, a list of dict, where the option name is set to value.
     """
-    val_loss, train_loss, sfens, epochs, lr, move_acc = [], [], [], [], [], []
+    new_options = [n for n in engine_options if name not in [k.lower() for k in n.keys()]]
+    new_options.append({name: str(value)})
+    return new_options
 
-    with open(sflog) as f:
-        for lines in f:
-            line = lines.rstrip()
 
-            # PROGRESS (calc_loss): Sun Mar 28 01:20:13 2021, 1000000 sfens, 37313 sfens/second, epoch 1
-            if 'PROGRESS' in line:
-                # Get sfens
-                value = int(line.split(' sfens')[0].split(', ')[1])
-                sfens.append(value)
+def get_param_value(param, name):
+    """
+    Returns the value of name in a list of dict param, the last one if there are several
+    like the engine does, or None.
+    """
+    value = None
+    for n in param:
+        for k, v in n.items():
+            if k.lower() == name:
+                value = v
+    return value
 
-                # Get epoch
-                value = int(line.split('epoch ')[1])
-                epochs.append(value)
 
-            # - learning rate = 1
-            elif 'learning rate = ' in line:
-                value = float(line.split('learning rate = ')[1])
-                lr.append(value)
+def get_score(t):
+    """
+    Returns the match score of a finished trial, it is the score user attr or the first
+    value of the trial, -inf if there is none.
+    """
+    score = t.user_attrs.get('score')
+    if score is None:
+        score = t.values[0] if t.values else float('-inf')
+    return score
 
-            # val_loss       = 0.0782639
-            elif 'val_loss' in line:
-                value = float(line.split('= ')[1])
-                val_loss.append(value)
 
-            # train_loss = 0.201731
-            elif 'train_loss' in line:
-                value = float(line.split('= ')[1])
-                train_loss.append(value)
+def get_strength(t):
+    """
+    Returns the value that ranks the nets of finished trials, the elo of the trial in the
+    elo objective, else its match score.
+    """
+    elo = t.user_attrs.get('elo')
+    return elo if elo is not None else get_score(t)
 
-            # - move accuracy = 0.4875%
-            elif 'move accuracy = ' in line and not 'random move accuracy = ' in line:
-                value = float(line.split('move accuracy = ')[1].split('%')[0])
-                move_acc.append(value)
 
-    # In the beginning, there is no train loss, we will insert a value from 2nd epoch.
-    if len(val_loss) - len(train_loss) == 1:
-        if len(train_loss):
-            value_to_insert = train_loss[0]
-            train_loss.insert(0, value_to_insert)
+def get_best_trial(study):
+    """
+    Returns the completed trial with the strongest net or None. It is the same as
+    study.best_trial for the score objective, and the strongest net when the objective
+    also counts the cost of the trials.
+    """
+    completed = study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.COMPLETE])
+    if not completed:
+        return None
+    return max(completed, key=get_strength)
 
-    # logger.debug(f'val_loss: {val_loss}')
-    # logger.debug(f'train_loss: {train_loss}')
 
-    return val_loss, train_loss, sfens, epochs, lr, move_acc
+def get_ledger_file(config, study_name, sub_study_folder):
+    """
+    The match ledger is next to the nets so that hosts that share the study share it.
+    """
+    return Path(config.get_artifact_dir(sub_study_folder), f'{study_name}_match_ledger.jsonl')
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        formatter_class=argparse.RawTextHelpFormatter,
-        prog='%s %s' % (__script_name__, __version__),
-        description=f'{__description__}',
-        epilog='%(prog)s')
-    parser.add_argument('--ini-file', required=True,
-                        help='The path/file or file of initialization file. Example:\n'
-                             'python mabigat.py --ini-file ./ini/example.ini')
+def replace_param_values(param, replace):
+    """
+    Returns a copy of a list of dict param with the values of the names in replace changed.
+    """
+    return [{k: replace.get(k.lower(), v) for k, v in n.items()} for n in param]
 
-    args = parser.parse_args()
 
-    # Get ini file
-    ini_file = args.ini_file
-    ini_file_path = Path(ini_file)
-    if not ini_file_path.is_file():
-        raise Exception(f'ini file {ini_file} does not exists, usage: mabigat.py --ini-file <your ini file>')
+def get_worker_folder(sub_study_folder, worker_id, workers):
+    """
+    A single worker uses the study folder as before. Every worker in a pool gets its
+    own folder where its train, val and evalsave folders are created and deleted.
+    """
+    if workers <= 1:
+        return Path(sub_study_folder)
+    return Path(sub_study_folder, f'worker_{worker_id}')
 
-    cwd = Path.cwd().as_posix()
 
-    # Get study name.
-    study_name = get_study_name(ini_file)
-    if study_name is None:
-        print('Error, define study_name in .ini file! under OPTUNA section')
-        raise
+def create_storage(storage_name):
+    """
+    Returns the optuna storage. A storage name that starts with journal: is a journal file
+    that can be shared by hosts through a shared file system, other names are database urls.
+    """
+    if not storage_name.startswith('journal:'):
+        return storage_name
+
+    journal_file = storage_name[len('journal:'):]
+    if hasattr(optuna.storages, 'JournalFileStorage'):
+        # optuna 3.x
+        lock = optuna.storages.JournalFileOpenLock(journal_file)
+        backend = optuna.storages.JournalFileStorage(journal_file, lock_obj=lock)
+    else:
+        lock = optuna.storages.journal.JournalFileOpenLock(journal_file)
+        backend = optuna.storages.journal.JournalFileBackend(journal_file, lock_obj=lock)
 
-    study_folder = Path(cwd, 'study')
-    create_folder(study_folder)
+    return optuna.storages.JournalStorage(backend)
 
-    sub_study_folder = Path(study_folder, study_name)
-    create_folder(sub_study_folder)
 
-    eval_save_folder = Path(sub_study_folder, 'evalsave')
+def publish_net(src, bins_folder, num_trials):
+    """
+    Moves the net to the artifact folder keyed by trial number. The net is renamed only
+    after it is completely written so that other hosts will not read a partial file.
+    """
+    dst = Path(bins_folder, f'{num_trials}_nn.bin')
+    move_data(src, dst)
+    return dst
 
-    log_filename = f'{sub_study_folder}/{study_name}_log.txt'
 
-    # Define logger in detail after we get the study name.
-    logger.setLevel(logging.DEBUG)
+def stop_process(proc):
+    """
+    Stops the match, match.py stops cutechess and its engines when it is terminated.
+    """
+    if os.name == 'nt':
+        subprocess.call(['taskkill', '/F', '/T', '/PID', str(proc.pid)],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        proc.terminate()
+    proc.wait()
 
-    fh = logging.FileHandler(filename=log_filename, mode='a')
-    fh.setLevel(logging.DEBUG)
 
-    ch = logging.StreamHandler(sys.stdout)
-    ch.setLevel(logging.INFO)
+def create_sampler(sampler_name, seed=100, parallel=False):
+    if sampler_name.lower() == 'cmaes':
+        # Avoid using categorical pram type.
+        # https://optuna.readthedocs.io/en/stable/reference/generated/optuna.samplers.CmaEsSampler.html
+        return optuna.samplers.CmaEsSampler(seed=seed)
 
-    fh_formatter = logging.Formatter('%(message)s')
-    ch_formatter = logging.Formatter('%(message)s')
-    fh.setFormatter(fh_formatter)
-    ch.setFormatter(ch_formatter)
+    # tpe
+    # https://optuna.readthedocs.io/en/stable/reference/generated/optuna.samplers.TPESampler.html
+    if parallel:
+        # Trials that are still running are considered by the other workers and by the
+        # pipeline so that they will not try the same param values.
+        return optuna.samplers.TPESampler(seed=seed, multivariate=False, constant_liar=True)
 
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+    return optuna.samplers.TPESampler(seed=seed, multivariate=False)
 
-    # --- mabigat ---
-    use_best_param = get_use_best_param(ini_file)
-    init_best_match_result = get_init_best_match_result(ini_file)
 
-    # --- optuna ---
-    n_trials = get_study_num_trials(ini_file)
+def get_match_command(cmd):
+    """
+    The command line is passed as is in Windows. In other OS the arguments are split
+    the same way the Windows command line does so that quoted values in the ini file
+    like time_control will stay as single arguments.
+    """
+    if os.name == 'nt':
+        return cmd
+    return shlex.split(cmd)
 
-    # --- engine ---
-    engine_file = get_engine_file(ini_file)
-    if engine_file is None:
-        logger.exception('Error, define engine_file in mabigat.ini file! under ENGINE section')
-        logger.exception('engine_file = path/toyourenginefile/eng.exe')
-        raise
-    threads = get_engine_threads(ini_file)
-    hash_mb = get_engine_hash_mb(ini_file)
-
-    # --- training / validation ---
-    train_depth = get_depth(ini_file)
-    val_depth = get_depth(ini_file, 'val')
-    numpos_train = get_num_positions(ini_file)
-    numpos_val = get_num_positions(ini_file, 'val')
-    book = get_book(ini_file)
-
-    # --- learning ---
-    eval_save_interval = get_eval_save_interval(ini_file)
-    loss_output_interval = get_loss_output_interval(ini_file)
-
-    # Define class where pos generation and learning methods are called.
-    engine_options = get_engine_options(ini_file)
-    nnue = TrainingSFNNUE(engine_file, engine_options, ini_file,
-                          sub_study_folder=sub_study_folder,
-                          eval_save_dir=eval_save_folder)
 
-    # Define storage, sampler and study.
-    storage_name = f'sqlite:///{sub_study_folder}/{study_name}.db'
+class MatchLedger:
+    """
+    Append-only file of the results of all matches, one json line per match with the
+    sha256 of the two nets, the time control, the book and the wins, draws and losses of
+    the first net. A pairing that was already played is not played again.
+    """
+    def __init__(self, fn):
+        self.fn = Path(fn)
+
+    def entries(self):
+        if not self.fn.is_file():
+            return []
+        entries = []
+        with open(self.fn) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # A line of a host that stopped while writing.
+                    continue
+        return entries
 
-    sampler_name = get_sampler(ini_file)
-    if sampler_name.lower() == 'cmaes':
-        # Avoid using categorical pram type.
-        # https://optuna.readthedocs.io/en/stable/reference/generated/optuna.samplers.CmaEsSampler.html
-        sampler = optuna.samplers.CmaEsSampler(seed=100)
-    else:
-        # tpe
-        # https://optuna.readthedocs.io/en/stable/reference/generated/optuna.samplers.TPESampler.html
-        sampler = optuna.samplers.TPESampler(seed=100, multivariate=False)
+    def find(self, net_a, net_b, time_control, book, games):
+        """
+        Returns (wins, draws, losses) of net_a against net_b from an earlier match of at
+        least games games or that was stopped by sprt, or None.
+        """
+        for e in reversed(self.entries()):
+            if e['time_control'] != time_control or e['book'] != book:
+                continue
+            if e['wins'] + e['draws'] + e['losses'] < games and e.get('sprt') is None:
+                continue
+            if (e['a'], e['b']) == (net_a, net_b):
+                return e['wins'], e['draws'], e['losses']
+            if (e['a'], e['b']) == (net_b, net_a):
+                return e['losses'], e['draws'], e['wins']
+        return None
+
+    def add(self, entry):
+        append_line(self.fn, json.dumps(entry))
+
+
+def fit_ratings(entries, iterations=1000):
+    """
+    Fits a Bradley-Terry model over the ledger entries, a draw is half a win. Returns
+    {net: (elo, error, games, trial)}. Every net gets one virtual draw against a net of
+    elo 0 so that a net that won or lost all its games still has a finite elo. The error
+    is one standard deviation from the diagonal of the fisher information.
+    """
+    score, pairs, trial_of = {}, {}, {}
+    for e in entries:
+        a, b = e['a'], e['b']
+        n = e['wins'] + e['draws'] + e['losses']
+        if n == 0 or a == b:
+            continue
+        trial_of[a], trial_of[b] = e.get('a_trial'), e.get('b_trial')
+        score[a] = score.get(a, 0) + e['wins'] + e['draws'] / 2
+        score[b] = score.get(b, 0) + e['losses'] + e['draws'] / 2
+        pairs.setdefault(a, {})
+        pairs.setdefault(b, {})
+        pairs[a][b] = pairs[a].get(b, 0) + n
+        pairs[b][a] = pairs[b].get(a, 0) + n
+
+    # Minorization-maximization of the strengths, gamma = 10 ** (elo / 400).
+    gamma = {net: 1.0 for net in pairs}
+    for _ in range(iterations):
+        change = 0.0
+        for net in pairs:
+            denominator = 1 / (gamma[net] + 1)
+            for other, n in pairs[net].items():
+                denominator += n / (gamma[net] + gamma[other])
+            value = (score[net] + 0.5) / denominator
+            change = max(change, abs(math.log(value / gamma[net])))
+            gamma[net] = value
+        if change < 1e-9:
+            break
+
+    ratings = {}
+    for net in pairs:
+        p0 = gamma[net] / (gamma[net] + 1)
+        information = p0 * (1 - p0)
+        games = 0
+        for other, n in pairs[net].items():
+            p = gamma[net] / (gamma[net] + gamma[other])
+            information += n * p * (1 - p)
+            games += n
+        elo = 400 * math.log10(gamma[net])
+        error = 400 / math.log(10) / math.sqrt(information)
+        ratings[net] = (elo, error, games, trial_of[net])
+    return ratings
+
+
+class TrialJournal:
+    """
+    The stages that a trial has done, gen_train, gen_val, learn, the fidelity rungs and
+    match, with the files and values of every stage. gen_train_started and gen_val_started
+    keep the folder of a gensfen that was interrupted, with its done shards. It is a json
+    file in the worker folder that is written again after every stage, so that a worker
+    that is started again resumes a trial that is still running in the study from its
+    last stage.
+    """
+    def __init__(self, fn, trial_number):
+        self.fn = Path(fn)
+        self.entry = {'trial': trial_number, 'host': socket.gethostname(), 'resumes': 0,
+                      'stages': {}, 'data': None}
 
-    study = optuna.create_study(
-        study_name=study_name,
-        storage=storage_name,
-        direction='maximize',
-        load_if_exists=True,
-        sampler=sampler
-    )
+    @classmethod
+    def load(cls, fn):
+        """
+        Returns the journal of the file or None if it cannot be read.
+        """
+        try:
+            with open(fn) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        journal = cls(fn, entry.get('trial'))
+        journal.entry.update(entry)
+        return journal
 
-    # Logging to file and console.
-    logger.info(f'Mabigat {__version__}')
-    logger.info(f'optuna {optuna.__version__}\n')
+    @property
+    def data(self):
+        return self.entry['data']
 
-    logger.info(f'engine   : {engine_file}')
-    logger.info(f'threads  : {threads}')
-    logger.info(f'hash     : {hash_mb}\n')
+    def get(self, stage):
+        return self.entry['stages'].get(stage)
 
-    logger.info(f'study name        : {study_name}')
-    logger.info(f'sampler/optimizer : {sampler_name}')
-    logger.info(f'number of trials  : {n_trials}\n')
+    def last_stage(self):
+        return list(self.entry['stages'])[-1] if self.entry['stages'] else None
 
-    logger.info(f'number of training positions  : {numpos_train}')
+    def record(self, stage, data=None, **info):
+        """
+        Records the stage as done, data are the files of the positions of the trial.
+        """
+        self.entry['stages'][stage] = info
+        if data is not None:
+            self.entry['data'] = data
+        self.write()
+
+    def write(self):
+        # A journal is never half written.
+        tmp = self.fn.with_name(f'{self.fn.name}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.entry, f, indent=2)
+        os.replace(tmp, self.fn)
+
+    def delete(self):
+        try:
+            self.fn.unlink()
+        except FileNotFoundError:
+            pass
 
-    if numpos_val == 0:
-        logger.info('number of validation positions: for optimization')
-    else:
-        logger.info(f'number of validation positions: {numpos_val}')
 
-    logger.info(f'training depth                : {train_depth}')
+class TrialWorker:
+    """
+    Runs the trials of a study. A trial first generates the training and validation positions,
+    then learns the net and plays a match to evaluate it. Several workers can run at the same
+    time in separate processes as they only share the study storage.
+    """
+    def __init__(self, config, study_name, storage_name, sub_study_folder, cwd,
+                 worker_id=0, workers=1, run_start=None):
+        self.config = config
 
-    if val_depth == 0:
-        logger.info('validation depth              : for optimization')
-    else:
-        logger.info(f'validation depth              : {val_depth}')
+        # Trials that were started before this run are not waited for.
+        self.run_start = time.time() if run_start is None else run_start
+        self.study_name = study_name
+        self.sub_study_folder = sub_study_folder
+        self.cwd = cwd
+        self.worker_id = worker_id
+
+        self.worker_folder = get_worker_folder(sub_study_folder, worker_id, workers)
+        create_folder(self.worker_folder)
+        self.eval_save_folder = Path(self.worker_folder, 'evalsave')
+
+        # --- mabigat ---
+        self.use_best_param = config.use_best_param
+        self.init_best_match_result = config.init_best_match_result
+        self.pipeline = config.pipeline
+
+        # --- engine ---
+        self.engine_file = config.engine_file
+        engine_options = config.engine_options
+        gen_engine_options = engine_options
+
+        # --- cutechess ---
+        self.concurrency = config.concurrency
+
+        # Split the cores of this machine between the workers.
+        if workers > 1 or self.pipeline:
+            worker_cores = split_cores(config.cores, workers)
+            engine_options = override_engine_option(engine_options, 'threads', worker_cores)
+            gen_engine_options = engine_options
+            self.concurrency = worker_cores
+
+            # The positions of the next trial are generated while this trial learns and
+            # plays its match. The generation cores are reserved, learning and the match
+            # use the rest.
+            if self.pipeline:
+                gen_cores = config.get_pipeline_gen_cores(worker_cores)
+                gen_engine_options = override_engine_option(engine_options, 'threads', gen_cores)
+                worker_cores = max(1, worker_cores - gen_cores)
+                engine_options = override_engine_option(engine_options, 'threads', worker_cores)
+                self.concurrency = worker_cores
+                logger.info(f'worker {worker_id}, pipeline generation cores: {gen_cores}, learning and match cores: {worker_cores}')
+            else:
+                logger.info(f'worker {worker_id}, cores: {worker_cores}')
+
+        # --- training / validation ---
+        self.numpos_train = config.numpos_train
+        self.train_depth = config.train_depth
+        self.numpos_val = config.numpos_val
+        self.val_depth = config.val_depth
+
+        # Define class where pos generation and learning methods are called.
+        self.nnue = TrainingSFNNUE(self.engine_file, engine_options, config,
+                                   sub_study_folder=sub_study_folder,
+                                   eval_save_dir=self.eval_save_folder)
+        self.gen_nnue = self.nnue
+
+        # Results of all the matches of the study.
+        self.ledger = MatchLedger(get_ledger_file(config, study_name, sub_study_folder))
+
+        # Engine threads of learning and of position generation for the cost of a trial.
+        self.learn_threads = int(get_param_value(engine_options, 'threads') or 1)
+        self.gen_threads = int(get_param_value(gen_engine_options, 'threads') or 1)
+        if gen_engine_options is not engine_options:
+            self.gen_nnue = TrainingSFNNUE(self.engine_file, gen_engine_options, config,
+                                           sub_study_folder=sub_study_folder,
+                                           eval_save_dir=self.eval_save_folder)
+
+        # Nets are published in the artifact folder which can be shared by several hosts.
+        self.bins_folder = f'{config.get_artifact_dir(sub_study_folder)}/{study_name}_net_bins'
+        Path(self.bins_folder).mkdir(parents=True, exist_ok=True)
+
+        # Validation positions generated with the same command, engine and book are reused.
+        self.val_cache = None
+        if config.val_cache:
+            self.val_cache = BinpackCache(config.val_cache_dir, config.val_cache_quota_mb)
+            if config.val_copy_training_param and config.training_gen_space and not config.validation_gen_space:
+                logger.warning('val_cache has no hits, the validation positions get the training params '
+                               'to optimize of every trial, set val_copy_training_param = 0')
+
+        # Training positions generated with the same gensfen command and seed are reused.
+        # The store is in the backup folder and shares the files with it by hard links.
+        self.backup_folder = f'{sub_study_folder}/{study_name}_train_and_val_bins'
+        self.train_store = None
+        if config.reuse_training_data:
+            self.train_store = BinpackCache(f'{self.backup_folder}/store', config.training_data_store_quota_mb)
+
+        # A row is added for every finished trial.
+        self.trial_log = TrialLog(f'{sub_study_folder}/{study_name}.csv', config.get_param_names())
+        self.trial_log.create()
+        self.status = WorkerStatus(Path(self.worker_folder, 'status.json'), worker_id)
+        self.stage_timer = StageTimer(f'{sub_study_folder}/{study_name}_timing.jsonl', worker_id,
+                                      status=self.status)
+        self.nnue.status = self.status
+        self.gen_nnue.status = self.status
+
+        # Limits the nets and positions that are kept.
+        self.retention = RetentionPolicy(config, study_name, self.bins_folder, self.backup_folder,
+                                         ledger=self.ledger if config.objective == 'elo' else None)
+
+        # The journals of the running trials and the interrupted trials to resume.
+        self.journals = {}
+        self.resumed = []
+
+        sampler = create_sampler(config.sampler, seed=100 + worker_id,
+                                 parallel=workers > 1 or self.pipeline)
+        self.study = optuna.load_study(study_name=study_name, storage=create_storage(storage_name),
+                                       sampler=sampler, pruner=config.create_pruner())
+
+    def run(self, n_trials):
+        """
+        Runs n_trials trials. In pipeline mode the next trial is asked before the current
+        trial learns, its positions are then generated in a thread at the same time.
+        """
+        self.status.n_trials = n_trials
+        try:
+            # The interrupted trials of this worker are run first as part of n_trials.
+            self.resumed = self.load_journals()
+            if self.pipeline:
+                self.run_pipeline(n_trials)
+            else:
+                for _ in range(n_trials):
+                    trial = self.ask()
+                    try:
+                        data = self.prepare_trial(trial, self.gen_nnue)
+                        self.finish_trial(trial, data)
+                    except Exception as err:
+                        self.fail_trial(trial, err)
+        finally:
+            # The engines are kept running between the stages and trials.
+            self.nnue.close()
+            self.gen_nnue.close()
+            self.status.close()
+
+    def ask(self):
+        """
+        Returns the next interrupted trial to resume or a new trial.
+        """
+        if self.resumed:
+            return self.resumed.pop(0)
+        return self.study.ask()
 
-    logger.info(f'book                          : {book}\n')
+    def tell(self, trial, value=None, state=None):
+        """
+        Tells the result of the trial to the study, adds it to the trial log and status.
+        """
+        frozen = self.study.tell(trial, value, state=state)
+        journal = self.journals.pop(trial.number, None)
+        if journal is not None:
+            journal.delete()
+        self.trial_log.append(frozen)
+        self.status.trial_done(self.study)
+
+    def get_journal(self, trial):
+        if trial.number not in self.journals:
+            self.journals[trial.number] = TrialJournal(
+                Path(self.worker_folder, f'trial_{trial.number}_journal.json'), trial.number)
+        return self.journals[trial.number]
+
+    def load_journals(self):
+        """
+        Returns the trials of the journals in the worker folder that are still running in
+        the study, the worker was stopped while it was running them. A trial that was
+        already resumed resume_trials times is told as failed.
+        """
+        trials = {t.number: t for t in self.study.get_trials(deepcopy=False)}
+        resumed = []
+        for fn in sorted(Path(self.worker_folder).glob('trial_*_journal.json')):
+            journal = TrialJournal.load(fn)
+            frozen = None if journal is None else trials.get(journal.entry['trial'])
+            if frozen is None or frozen.state != optuna.trial.TrialState.RUNNING \
+                    or journal.entry['host'] != socket.gethostname():
+                fn.unlink()
+                continue
+
+            # Optuna has no public api to get a running trial back.
+            trial = optuna.trial.Trial(self.study, frozen._trial_id)
+            self.journals[trial.number] = journal
+            journal.entry['resumes'] += 1
+            journal.write()
+
+            if journal.entry['resumes'] > self.config.resume_trials:
+                self.fail_trial(trial, f'trial {trial.number} was interrupted {journal.entry["resumes"]} times')
+                continue
+
+            logger.info(f'resume trial {trial.number}, last stage done: {journal.last_stage()}')
+            resumed.append(trial)
+        return resumed
+
+    def run_pipeline(self, n_trials):
+        # A trial is only asked when it will be run, else it stays running in the study.
+        if n_trials <= 0:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            trial = self.ask()
+            next_data = executor.submit(self.prepare_trial, trial, self.gen_nnue)
+
+            for i in range(n_trials):
+                try:
+                    data = next_data.result()
+                except Exception as err:
+                    self.fail_trial(trial, err)
+                    data = None
+
+                next_trial = None
+                if i + 1 < n_trials:
+                    next_trial = self.ask()
+                    next_data = executor.submit(self.prepare_trial, next_trial, self.gen_nnue)
+
+                if data is not None:
+                    try:
+                        self.finish_trial(trial, data)
+                    except Exception as err:
+                        self.fail_trial(trial, err)
+
+                trial = next_trial
+
+    def fail_trial(self, trial, err):
+        """
+        The engine crashed or hung or the trial has another error, the trial is told as
+        failed and the study continues with the next trial.
+        """
+        logger.error(f'trial {trial.number} failed, {err}',
+                     exc_info=isinstance(err, Exception) and not isinstance(err, EngineError))
+        self.status.abort(trial)
 
-    logger.info(f'eval_save_interval  : {eval_save_interval}')
-    logger.info(f'loss_output_interval: {loss_output_interval}\n')
+        # The error came after the trial was told, its result and positions are kept.
+        told = [t for t in self.study.get_trials(deepcopy=False) if t.number == trial.number]
+        if told and told[0].state.is_finished():
+            return
 
-    # Start the optimization.
-    for _ in range(n_trials):
+        trial.set_user_attr('fail_reason', str(err))
+        self.tell(trial, state=optuna.trial.TrialState.FAIL)
+        delete_folder(f'{self.worker_folder}/train_{trial.number}')
+        delete_folder(f'{self.worker_folder}/val_{trial.number}')
 
-        num_trials = len(study.trials)
+    def prepare_trial(self, trial, nnue):
+        """
+        Asks the param values of position generation and generates the training and validation
+        positions. Returns the folders and files of the generated positions.
+        """
+        num_trials = trial.number
         logger.info(f'starting trial: {num_trials}')
 
-        trial = study.ask()
+        # A resumed trial whose positions are generated or whose net is learned.
+        journal = self.get_journal(trial)
+        if journal.get('learn') is not None or (
+                journal.get('gen_val') is not None and self.has_positions(journal.data)):
+            logger.info(f'trial {num_trials} positions are already generated')
+            return journal.data
 
         # 2. Generate training positions
         # Manage folders and files.
-        positions, depth = numpos_train, train_depth
+        positions, depth = self.numpos_train, self.train_depth
         mode = 'train'
-        train_folder = f'{sub_study_folder}/train'
-
-        delete_folder(train_folder)
-        create_folder(train_folder)
-        train_nn_output_path_file = f'{train_folder}/{study_name}_training_trial_{num_trials}_pos_{positions}_depth_{depth}.binpack'
-        train_nn_output_file = f'{study_name}_training_trial_{num_trials}_pos_{positions}_depth_{depth}.binpack'
+        train_folder = f'{self.worker_folder}/train_{num_trials}'
 
         # Get the params that are not to be optimized.
-        training_gen_param = get_training_gen_param(ini_file)
+        training_gen_param = list(self.config.training_gen_param)
 
         # Get the params that are to be optimized.
-        training_gen_param_to_optimize = get_training_gen_param_to_optimize(ini_file, trial)
+        training_gen_param_to_optimize = self.config.suggest(
+            trial, self.config.training_gen_space, 'pos gen for training')
         if len(training_gen_param_to_optimize):
             logger.debug(f'Training pos generation param to optimize:')
             for n in training_gen_param_to_optimize:
                 logger.debug(n)
 
-        logger.info('generating training positions ...')
+        # In multi-fidelity mode the trial starts with the positions of the first rung.
+        gen_param, gen_param_to_optimize = training_gen_param, training_gen_param_to_optimize
+        if self.config.fidelity_rungs > 1:
+            positions = self.get_rung_positions(training_gen_param, training_gen_param_to_optimize, 0)
+            gen_param = replace_param_values(training_gen_param, {'num_pos': positions})
+            gen_param_to_optimize = replace_param_values(training_gen_param_to_optimize, {'num_pos': positions})
+        train_positions = positions
 
-        # Generate positions.
-        nnue.generate_positions(
-            num_trials,
-            mode,
-            study_name,
-            train_nn_output_path_file,
-            training_gen_param,
-            training_gen_param_to_optimize
-        )
+        train_nn_output_file = f'{self.study_name}_training_trial_{num_trials}_pos_{positions}_depth_{depth}.{self.config.sfen_format}'
+        train_nn_output_path_file = f'{train_folder}/{train_nn_output_file}'
+
+        if journal.get('gen_train') is not None and Path(train_nn_output_path_file).is_file():
+            logger.info(f'trial {num_trials} training positions are already generated')
+        else:
+            # The done shards of an interrupted gensfen are generated only once.
+            if journal.get('gen_train_started') is None:
+                delete_folder(train_folder)
+            create_folder(train_folder)
+            journal.record('gen_train_started')
+
+            logger.info('generating training positions ...')
+
+            # Generate positions.
+            stage_start = self.stage_timer.start(trial, 'train_gen')
+            cached = nnue.generate_positions(
+                num_trials,
+                mode,
+                self.study_name,
+                train_nn_output_path_file,
+                gen_param,
+                gen_param_to_optimize,
+                cache=self.train_store
+            )
+            seconds = time.perf_counter() - stage_start
+            self.stage_timer.record(trial, 'train_gen', seconds, cached=cached,
+                                    sfens_per_second=None if cached else get_rate(positions, seconds))
+            journal.record('gen_train', file=train_nn_output_path_file)
 
 
         # 3. Generate validation positions
         # Manage folders and files.
-        positions, depth = numpos_val, val_depth
+        positions, depth = self.numpos_val, self.val_depth
         mode = 'val'
-        val_folder = f'{sub_study_folder}/val'
+        val_folder = f'{self.worker_folder}/val_{num_trials}'
 
-        delete_folder(val_folder)
+        if journal.get('gen_val_started') is None:
+            delete_folder(val_folder)
         create_folder(val_folder)
+        journal.record('gen_val_started')
 
         # Get the params that are not to be optimized.
-        validation_gen_param = get_validation_gen_param(ini_file)
+        validation_gen_param = list(self.config.validation_gen_param)
 
         # Add training param.
         for n in training_gen_param:
@@ -1015,8 +2401,9 @@ def main():
                     validation_gen_param.append(n)
 
         # Get the params that are to be optimized.
-        validation_gen_param_to_optimize = get_validation_gen_param_to_optimize(ini_file, trial)
-        if len(validation_gen_param_to_optimize) == 0:
+        validation_gen_param_to_optimize = self.config.suggest(
+            trial, self.config.validation_gen_space, 'pos gen for validation')
+        if len(validation_gen_param_to_optimize) == 0 and self.config.val_copy_training_param:
             validation_gen_param_to_optimize = copy.copy(training_gen_param_to_optimize)
 
         if len(validation_gen_param_to_optimize):
@@ -1036,168 +2423,561 @@ def main():
                 if found:
                     break
 
-        val_nn_output_file = f'{study_name}_validation_trial_{num_trials}_pos_{positions}_depth_{depth}.binpack'
+        val_nn_output_file = f'{self.study_name}_validation_trial_{num_trials}_pos_{positions}_depth_{depth}.{self.config.sfen_format}'
         val_nn_output_path_file = f'{val_folder}/{val_nn_output_file}'
 
         logger.info('generating validation positions ...')
 
         # Generate positions.
-        nnue.generate_positions(
+        stage_start = self.stage_timer.start(trial, 'val_gen')
+        cached = nnue.generate_positions(
             num_trials,
             mode,
-            study_name,
+            self.study_name,
             val_nn_output_path_file,
             validation_gen_param,
-            validation_gen_param_to_optimize
+            validation_gen_param_to_optimize,
+            cache=self.val_cache
         )
+        seconds = time.perf_counter() - stage_start
+        self.stage_timer.record(trial, 'val_gen', seconds, cached=cached,
+                                sfens_per_second=None if cached else get_rate(positions, seconds))
+
+        self.merge_positions(trial, train_nn_output_path_file, val_nn_output_path_file)
+
+        data = {
+            'train_folder': train_folder,
+            'train_files': [train_nn_output_file],
+            'train_param': training_gen_param,
+            'train_param_to_optimize': training_gen_param_to_optimize,
+            'positions': train_positions,
+            'val_folder': val_folder,
+            'val_file': val_nn_output_file,
+            'val_path_file': val_nn_output_path_file
+        }
+        journal.record('gen_val', data=data, file=val_nn_output_path_file)
+
+        return data
+
+    def has_positions(self, data):
+        """
+        Returns True if the position files of data are in the trial folders or in the
+        backup folder.
+        """
+        files = [(f'{data["train_folder"]}/{fn}', fn) for fn in data['train_files']]
+        files.append((data['val_path_file'], data['val_file']))
+        return all(Path(path).is_file() or Path(self.backup_folder, fn).is_file() for path, fn in files)
 
-        # 4. Learning
+    def merge_positions(self, trial, train_path_file, val_path_file):
+        """
+        Removes duplicates and validation positions from the training positions.
+        """
+        if not (self.config.dedup_training_data or self.config.shuffle_training_data):
+            return
+
+        stage_start = self.stage_timer.start(trial, 'merge')
+        exclude = None
+        if binpack_tool.get_format(val_path_file) == 'bin':
+            exclude = val_path_file
+        stats = binpack_tool.merge(
+            [train_path_file], train_path_file, exclude=exclude,
+            shuffle=self.config.shuffle_training_data, dedup=self.config.dedup_training_data,
+            memory_mb=self.config.training_data_memory_mb)
+        logger.info(f'training positions are merged, {stats}')
+        self.stage_timer.record(trial, 'merge', time.perf_counter() - stage_start)
+
+    def backup_positions(self, data):
+        """
+        Moves the training and validation positions to the backup folder and deletes the
+        folders of the trial.
+        """
+        create_folder(self.backup_folder)
 
-        delete_folder(eval_save_folder)
-        create_folder(eval_save_folder)
-        bins_folder = f'{sub_study_folder}/{study_name}_net_bins'
-        create_folder(bins_folder)
-        targetdir = train_folder
-        learning_param = get_learning_param(ini_file)
-        learning_param_to_optimize = get_learning_param_to_optimize(ini_file, trial)
+        # Backup the training files. A resumed trial may have moved them already.
+        for train_file in data['train_files']:
+            src = f'{data["train_folder"]}/{train_file}'
+            if Path(src).is_file() or not Path(self.backup_folder, train_file).is_file():
+                move_data(src, f'{self.backup_folder}/{train_file}')
 
-        if len(learning_param_to_optimize):
-            logger.debug(f'Learning param to optimize:')
-            for n in learning_param_to_optimize:
-                logger.debug(n)
+        # Backup the validation file.
+        if Path(data['val_path_file']).is_file() or not Path(self.backup_folder, data['val_file']).is_file():
+            move_data(data['val_path_file'], f'{self.backup_folder}/{data["val_file"]}')
 
-        logger.info('run learning ...')
+        # Cleanup
+        delete_folder(data['train_folder'])
+        delete_folder(data['val_folder'])
+
+    def record_learn(self, trial, learn_start):
+        """
+        The learning plot is written during learning, its time is not counted as learning.
+        """
+        seconds = time.perf_counter() - learn_start
+        speeds = self.nnue.learn_speeds
+        self.stage_timer.record(trial, 'plot', self.nnue.plot_time)
+        self.stage_timer.record(trial, 'learn', max(0.0, seconds - self.nnue.plot_time),
+                                sfens_per_second=sum(speeds) / len(speeds) if speeds else None)
+
+    def get_opponent(self, trial):
+        """
+        Returns the values and number of the trial whose net is the opponent in the match.
+        When trials run at the same time, the net of the best trial may not be published
+        yet, then the strongest published net is used. If no other net is published, it
+        waits for the running trials of the other workers, at most opponent_wait_timeout
+        seconds. The number is None if no other trial published a net, this trial then
+        has the first net of the study.
+        """
+        wait_start = time.perf_counter()
+        while True:
+            best_trial_value, best_trial_num = self.find_opponent(trial)
+            if best_trial_num is not None or not self.has_other_running_trials(trial):
+                return best_trial_value, best_trial_num
+            if time.perf_counter() - wait_start >= self.config.opponent_wait_timeout:
+                logger.warning(f'trial {trial.number} has no opponent after {self.config.opponent_wait_timeout}s')
+                return best_trial_value, best_trial_num
+            logger.info(f'trial {trial.number} waits for the net of another trial ...')
+            time.sleep(OPPONENT_WAIT)
+
+    def find_opponent(self, trial):
+        """
+        Returns the values and number of the trial with the strongest published net other
+        than the net of trial. The trials that are not completed come after the completed
+        trials, the newest net first.
+        """
+        completed = self.study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.COMPLETE])
+        candidates = sorted(completed, key=get_strength, reverse=True)
+        if self.config.objective == 'elo':
+            top_rated = self.get_top_rated_trial()
+            if top_rated is not None:
+                candidates.insert(0, top_rated)
+
+        # The fixed opponent is the net of the first trial.
+        if not self.use_best_param:
+            candidates = [t for t in self.study.get_trials(deepcopy=False) if t.number == 0] + candidates
+
+        for t in candidates:
+            if t.number != trial.number and self.has_net(t.number):
+                value = [get_score(t)] if t.state == optuna.trial.TrialState.COMPLETE else None
+                return value, t.number
+
+        others = [t.number for t in self.study.get_trials(deepcopy=False)
+                  if t.number != trial.number and self.has_net(t.number)]
+        if others:
+            return None, max(others, key=lambda n: Path(self.bins_folder, f'{n}_nn.bin').stat().st_mtime)
+        return None, None
+
+    def has_net(self, num_trials):
+        return Path(self.bins_folder, f'{num_trials}_nn.bin').is_file()
+
+    def has_other_running_trials(self, trial):
+        """
+        Returns True if a trial of another worker of this run is running, it may still
+        publish a net. The trials of this worker wait for this trial in pipeline mode, and
+        a trial that was started before this run was left running by a stopped run.
+        """
+        return any(t.number != trial.number and t.number not in self.journals
+                   and t.datetime_start is not None and t.datetime_start.timestamp() >= self.run_start
+                   for t in self.study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.RUNNING]))
 
-        nnue.learn(
+    def get_net_digest(self, num_trials):
+        fn = Path(self.bins_folder, f'{num_trials}_nn.bin')
+        return get_file_digest(fn) if fn.is_file() else None
+
+    def get_top_rated_trial(self):
+        """
+        Returns the completed trial whose net has the highest elo from all the matches in
+        the ledger or None. The elo of the trials that were told earlier may have changed
+        with the matches that were played since.
+        """
+        ratings = fit_ratings(self.ledger.entries())
+        best, best_elo = None, None
+        for t in self.study.get_trials(deepcopy=False, states=[optuna.trial.TrialState.COMPLETE]):
+            rating = ratings.get(self.get_net_digest(t.number))
+            if rating is not None and (best_elo is None or rating[0] > best_elo):
+                best, best_elo = t, rating[0]
+        return best
+
+    def get_rung_positions(self, param, param_to_optimize, rung):
+        """
+        Returns the number of training positions of the fidelity rung.
+        """
+        num_pos = int(get_param_value(param_to_optimize + param, 'num_pos'))
+        return max(1, int(num_pos * self.config.get_budgets()[rung]))
+
+    def add_positions(self, trial, data, rung):
+        """
+        Generates the training positions that the trial still needs for the fidelity rung
+        in a new file of the train folder, learning uses all the files in the folder.
+        """
+        num_trials = trial.number
+        param, param_to_optimize = data['train_param'], data['train_param_to_optimize']
+        positions = self.get_rung_positions(param, param_to_optimize, rung)
+        extra = positions - data['positions']
+        if extra <= 0:
+            return
+
+        # The new positions should not be the same as the positions of the lower rungs.
+        replace = {'num_pos': extra}
+        seed = get_param_value(param_to_optimize + param, 'seed')
+        if seed is not None:
+            replace['seed'] = f'{seed}_rung{rung}'
+
+        train_file = f'{self.study_name}_training_trial_{num_trials}_pos_{extra}_depth_{self.train_depth}_rung_{rung}.{self.config.sfen_format}'
+        train_path_file = f'{data["train_folder"]}/{train_file}'
+
+        logger.info(f'generating {extra} more training positions for rung {rung} ...')
+        stage_start = self.stage_timer.start(trial, 'train_gen')
+        cached = self.nnue.generate_positions(
             num_trials,
-            study_name,
-            targetdir,
-            val_nn_output_path_file,
-            learning_param,
-            learning_param_to_optimize
+            'train',
+            self.study_name,
+            train_path_file,
+            replace_param_values(param, replace),
+            replace_param_values(param_to_optimize, replace),
+            cache=self.train_store
         )
+        seconds = time.perf_counter() - stage_start
+        self.stage_timer.record(trial, 'train_gen', seconds, cached=cached, rung=rung,
+                                sfens_per_second=None if cached else get_rate(extra, seconds))
 
-        # Backup bins after learning is done.
-        time.sleep(3)
-        move_data(f'{eval_save_folder}/final/nn.bin', f'{bins_folder}/{num_trials}_nn.bin')
+        self.merge_positions(trial, train_path_file, data['val_path_file'])
+        data['train_files'].append(train_file)
+        data['positions'] = positions
 
-        # Backup train and val bins
-        time.sleep(3)
-        backup_folder = f'{sub_study_folder}/{study_name}_train_and_val_bins'
-        create_folder(backup_folder)
+    def learn_net(self, trial, data, learning_param, learning_param_to_optimize, report_interval):
+        """
+        Learns the net from the positions in data and publishes it. Returns False if
+        learning is pruned.
+        """
+        num_trials = trial.number
 
-        # Backup the training file.
-        time.sleep(3)
-        move_data(train_nn_output_path_file, f'{backup_folder}/{train_nn_output_file}')
+        delete_folder(self.eval_save_folder)
+        create_folder(self.eval_save_folder)
 
-        # Backup the validation file.
-        time.sleep(3)
-        move_data(val_nn_output_path_file, f'{backup_folder}/{val_nn_output_file}')
+        logger.info('run learning ...')
 
-        # Cleanup
-        time.sleep(3)
-        delete_folder(train_folder)
-        delete_folder(val_folder)
+        learn_start = self.stage_timer.start(trial, 'learn')
+        try:
+            self.nnue.learn(
+                num_trials,
+                self.study_name,
+                data['train_folder'],
+                data['val_path_file'],
+                learning_param,
+                learning_param_to_optimize,
+                trial=trial,
+                report_interval=report_interval
+            )
+        except optuna.TrialPruned:
+            self.record_learn(trial, learn_start)
+            return False
+        self.record_learn(trial, learn_start)
+
+        # The net is moved once it is completely saved.
+        stage_start = self.stage_timer.start(trial, 'move')
+        net_file = publish_net(f'{self.eval_save_folder}/final/nn.bin', self.bins_folder, num_trials)
+        trial.set_user_attr('host', socket.gethostname())
+        trial.set_user_attr('net_file', net_file.name)
+        self.stage_timer.record(trial, 'move', time.perf_counter() - stage_start)
+        return True
+
+    def play_match(self, trial, best_trial_num, rounds, report_interval):
+        """
+        Plays the match of the net of trial against the net of best_trial_num. Returns the
+        result, the number of games and True if the pruner stopped the match. The result is
+        None if the match failed.
+        """
+        num_trials = trial.number
+        python_file = self.config.python_file
+        cutechess_cli_path = self.config.cutechess_cli_path
+        time_control = self.config.time_control
+        book = self.config.cutechess_book
+        draw = self.config.draw
+        resign = self.config.resign
+        sprt = self.config.get_sprt()
+
+        match_result, match_games, match_pruned = None, 0, False
+
+        # The same nets at the same time control and book were already tested.
+        net_a, net_b = self.get_net_digest(num_trials), self.get_net_digest(best_trial_num)
+        wdl = self.ledger.find(net_a, net_b, time_control, book, rounds * 2)
+        if wdl is not None:
+            match_games = sum(wdl)
+            match_result = (wdl[0] + wdl[1] / 2) / match_games
+            logger.info(f'The match between {num_trials}_nn.bin and {best_trial_num}_nn.bin is in the ledger, result: {match_result:0.5f}, games: {match_games}')
+            trial.set_user_attr('match_games', match_games)
+            return match_result, match_games, match_pruned
+
+        tour_start = self.stage_timer.start(trial, 'match')
+        opt1_1 = f'name={num_trials}_nn'
+        nn_path = Path(self.cwd, f'{self.bins_folder}/{num_trials}_nn.bin')
+        opt1_2 = f'option.EvalFile={nn_path}'
+
+        opt2_1 = f'name={best_trial_num}_nn'
+        nn_path = Path(self.cwd, f'{self.bins_folder}/{best_trial_num}_nn.bin')
+        opt2_2 = f'option.EvalFile={nn_path}'
+
+        if sprt is None:
+            logger.info(f'Execute engine vs engine match for {rounds*2} games between {num_trials}_nn.bin and {best_trial_num}_nn.bin ...')
+        else:
+            logger.info(f'Execute engine vs engine match for up to {rounds*2} games with sprt {sprt} between {num_trials}_nn.bin and {best_trial_num}_nn.bin ...')
+
+        cmd = f'{python_file} match.py {self.sub_study_folder} {self.study_name} {cutechess_cli_path} ' \
+              f'{self.engine_file} {opt1_1} {opt1_2} {opt2_1} {opt2_2} {rounds} {time_control} ' \
+              f'{book} {self.concurrency} {draw} {resign} {sprt}'
+        logger.debug(f'cmd: {cmd}')
+
+        match = subprocess.Popen(
+            get_match_command(cmd), stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            bufsize=1
+        )
+        wdl, stopped = None, None
+        for eline in iter(match.stdout.readline, ''):
+            line = eline.strip()
+            if line.startswith('progress '):
+                match_games, score = int(line.split()[1]), float(line.split()[2])
+                self.status.progress('match', games=match_games, score=score)
+
+                # Let the pruner decide if this trial can be stopped.
+                if report_interval > 0 and match_games % report_interval == 0:
+                    trial.report(score, step=MATCH_STEP_OFFSET + match_games)
+                    if trial.should_prune():
+                        logger.info(f'trial {num_trials} is pruned after {match_games} games, score: {score}')
+                        stop_process(match)
+                        match_pruned = True
+                        break
+            elif line.startswith('games '):
+                match_games = int(line.split('games ')[1])
+            elif line.startswith('wdl '):
+                wdl = [int(n) for n in line.split()[1:4]]
+            elif line.startswith('sprt '):
+                stopped = line.split()[1]
+                logger.info(f'sprt stopped the match, {stopped} is accepted')
+            elif line.startswith('result '):
+                match_result = float(line.split('result ')[1])
+                break
 
-        # 5. Create match to test the nn output.
-        time.sleep(3)
-        reported_match_result = init_best_match_result
+        logger.debug(f'tour elapse (s): {time.perf_counter() - tour_start: 0.1f}, games: {match_games}')
+        trial.set_user_attr('match_games', match_games)
+        seconds = time.perf_counter() - tour_start
+        self.stage_timer.record(trial, 'match', seconds, games_per_second=get_rate(match_games, seconds))
 
-        python_file = get_python_file(ini_file)
-        rounds = get_cutechess_rounds(ini_file)
-        cutechess_cli_path = get_cutechess_cli_path(ini_file)
-        time_control = get_cutechess_time_control(ini_file)
-        book = get_cutechess_book(ini_file)
-        concurrency = get_cutechess_concurrency(ini_file)
-        draw = get_cutechess_draw(ini_file)
-        resign = get_cutechess_resign(ini_file)
+        if match_pruned:
+            logger.info(f'Match stopped at {match_games} games, point of view: {opt1_1}')
+        elif match_result is not None:
+            logger.info(f'Match done! actual result: {match_result}, point of view: {opt1_1}')
+            if wdl is not None and net_a is not None and net_b is not None:
+                self.ledger.add({'a': net_a, 'b': net_b, 'a_trial': num_trials, 'b_trial': best_trial_num,
+                                 'time_control': time_control, 'book': book,
+                                 'wins': wdl[0], 'draws': wdl[1], 'losses': wdl[2], 'sprt': stopped,
+                                 'time': time.strftime('%Y-%m-%d %H:%M:%S')})
 
-        match_result, pruned_trial = None, False
+        return match_result, match_games, match_pruned
 
-        if num_trials >= 1:
-            tour_start = time.perf_counter()
-            opt1_1 = f'name={num_trials}_nn'
-            nn_path = Path(cwd, f'{bins_folder}/{num_trials}_nn.bin')
-            opt1_2 = f'option.EvalFile={nn_path}'
+    def run_rungs(self, trial, data, learning_param, learning_param_to_optimize, best_trial_num):
+        """
+        Multi-fidelity, the net is learned and tested with the positions and rounds of every
+        rung below the full budget. The match result of a rung is reported to the pruner
+        with the rung as the step, a trial that is not promoted is told as pruned. Returns
+        True if the trial reached the full budget. A resumed trial starts at the rung of its
+        journal.
+        """
+        journal = self.get_journal(trial)
+        start = (journal.get('rung') or {}).get('rung', 0)
+        budgets = self.config.get_budgets()
+        for rung, budget in enumerate(budgets[:-1]):
+            if rung < start:
+                continue
+            logger.info(f'trial {trial.number} rung {rung}, positions: {data["positions"]}, rounds: {self.config.get_rounds(budget)}')
+            self.learn_net(trial, data, learning_param, learning_param_to_optimize, report_interval=0)
+            match_result, _, _ = self.play_match(trial, best_trial_num, self.config.get_rounds(budget), report_interval=0)
+            if match_result is None:
+                logger.error(f'There is error in the match of rung {rung}, prune this trial.')
+                return False
 
-            try:
-                best_trial_value = study.best_trial.values  # a list
-            except ValueError:
-                best_trial_value = None
+            trial.set_user_attr('fidelity_rung', rung)
+            trial.report(match_result, step=self.config.get_rung_step(rung))
+            if trial.should_prune():
+                logger.info(f'trial {trial.number} is not promoted after rung {rung}, score: {match_result}')
+                return False
 
-            if use_best_param:
-                best_trial_num = study.best_trial.number
-                opt2_1 = f'name={best_trial_num}_nn'
-                nn_path = Path(cwd, f'{bins_folder}/{best_trial_num}_nn.bin')
-                opt2_2 = f'option.EvalFile={nn_path}'
-            else:
-                best_trial_num = 0
-                opt2_1 = f'name={best_trial_num}_nn'
-                nn_path = Path(cwd, f'{bins_folder}/{best_trial_num}_nn.bin')
-                opt2_2 = f'option.EvalFile={nn_path}'
+            self.add_positions(trial, data, rung + 1)
+            journal.record('rung', data=data, rung=rung + 1)
 
-            logger.info(f'Execute engine vs engine match for {rounds*2} games between {num_trials}_nn.bin and {best_trial_num}_nn.bin ...')
+        trial.set_user_attr('fidelity_rung', len(budgets) - 1)
+        return True
 
-            cmd = f'{python_file} match.py {sub_study_folder} {study_name} {cutechess_cli_path} ' \
-                  f'{engine_file} {opt1_1} {opt1_2} {opt2_1} {opt2_2} {rounds} {time_control} ' \
-                  f'{book} {concurrency} {draw} {resign}'
-            logger.debug(f'cmd: {cmd}')
-
-            match = subprocess.Popen(
-                cmd, stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                universal_newlines=True,
-                bufsize=1
-            )
-            for eline in iter(match.stdout.readline, ''):
-                line = eline.strip()
-                if 'result ' in line:
-                    match_result = float(line.split('result ')[1])
-                    break
+    def finish_trial(self, trial, data):
+        """
+        Learns the net from the positions in data, plays the match and tells the result
+        to the study.
+        """
+        num_trials = trial.number
+        journal = self.get_journal(trial)
 
-            logger.debug(f'tour elapse (s): {time.perf_counter() - tour_start: 0.1f}, games: {rounds*2}')
+        # 4. Learning
 
-            # If match result is broken, we continue the study but prune this trial.
-            if match_result is None:
-                logger.exception('There is error in the match, prune this trial.')
-                pruned_trial = True
-            else:
-                logger.info(f'Match done! actual result: {match_result}, point of view: {opt1_1}')
-
-                if use_best_param:
-                    # If we use the best param so far against the suggested values from the optimizer
-                    # we need to adjust the result value reported to optimizer.
-                    if match_result > init_best_match_result:
-                        result_diff = match_result - init_best_match_result
-
-                        # Get the best value of best trial from trials history.
-                        if best_trial_value is not None:
-                            current_best_trial_value = float(best_trial_value[0])  # get index 0 for single objective
-                            reported_match_result = current_best_trial_value + result_diff
+        learning_param = list(self.config.learning_param)
+        learning_param_to_optimize = self.config.suggest(trial, self.config.learning_space, 'learning')
+
+        if len(learning_param_to_optimize):
+            logger.debug(f'Learning param to optimize:')
+            for n in learning_param_to_optimize:
+                logger.debug(n)
+
+        # The rungs play against a net that is already published. The first trial has no
+        # opponent, its net is the first net of the study.
+        best_trial_value, best_trial_num = None, None
+        if num_trials >= 1:
+            best_trial_value, best_trial_num = self.find_opponent(trial)
+        has_match = best_trial_num is not None
+
+        # In multi-fidelity mode the rungs report to the pruner instead of learning and
+        # the match. A trial without an opponent goes to the full budget at once.
+        learn_report_interval = self.config.learn_report_interval
+        report_interval = self.config.match_report_interval
+        if self.config.objective == 'pareto':
+            # Optuna has no intermediate values for several objectives.
+            learn_report_interval, report_interval = 0, 0
+        # A resumed trial whose net is learned goes to the match.
+        learned = journal.get('learn') is not None and Path(self.bins_folder, f'{num_trials}_nn.bin').is_file()
+        if learned:
+            logger.info(f'trial {num_trials} net is already learned')
+
+        if self.config.fidelity_rungs > 1:
+            learn_report_interval, report_interval = 0, 0
+        if self.config.fidelity_rungs > 1 and not learned:
+            if not has_match:
+                self.add_positions(trial, data, self.config.fidelity_rungs - 1)
+                journal.record('rung', data=data, rung=self.config.fidelity_rungs - 1)
+            elif not self.run_rungs(trial, data, learning_param, learning_param_to_optimize, best_trial_num):
+                self.backup_positions(data)
+                self.tell(trial, state=optuna.trial.TrialState.PRUNED)
+                self.cleanup_trial()
+                return
+
+        if not learned:
+            if not self.learn_net(trial, data, learning_param, learning_param_to_optimize, learn_report_interval):
+                # There is no net to test, keep the positions and skip the match.
+                stage_start = self.stage_timer.start(trial, 'move')
+                self.backup_positions(data)
+                self.stage_timer.record(trial, 'move', time.perf_counter() - stage_start)
+                self.tell(trial, state=optuna.trial.TrialState.PRUNED)
+                logger.info(f'trial {num_trials} is pruned during learning')
+                self.cleanup_trial()
+                return
+            journal.record('learn', net_file=trial.user_attrs.get('net_file'))
+
+        # Backup train and val bins
+        stage_start = self.stage_timer.start(trial, 'move')
+        self.backup_positions(data)
+        self.stage_timer.record(trial, 'move', time.perf_counter() - stage_start)
+
+        # Find the opponent of this trial's net now that it is published, the trials that
+        # run at the same time can play each other.
+        if num_trials >= 1 and journal.get('match') is None:
+            best_trial_value, best_trial_num = self.get_opponent(trial)
+            has_match = best_trial_num is not None
+
+        # 5. Create match to test the nn output.
+        # A resumed trial whose match is played is only told.
+        match = journal.get('match')
+        if match is None:
+            reported_match_result = self.init_best_match_result
+
+            rounds = self.config.rounds
+
+            match_result, pruned_trial, match_pruned = None, False, False
+
+            if has_match:
+                match_result, _, match_pruned = self.play_match(trial, best_trial_num, rounds, report_interval)
+
+                # If match result is broken, we continue the study but prune this trial.
+                if match_result is None and not match_pruned:
+                    logger.error('There is error in the match, prune this trial.')
+                    pruned_trial = True
+                elif not match_pruned:
+                    if self.use_best_param:
+                        # If we use the best param so far against the suggested values from the optimizer
+                        # we need to adjust the result value reported to optimizer.
+                        if match_result > self.init_best_match_result:
+                            result_diff = match_result - self.init_best_match_result
+
+                            # Get the best value of best trial from trials history.
+                            if best_trial_value is not None:
+                                current_best_trial_value = float(best_trial_value[0])  # get index 0 for single objective
+                                reported_match_result = current_best_trial_value + result_diff
+                            else:
+                                reported_match_result = match_result
+                                logger.info(f'There is no best value yet in the trial history. '
+                                            f'Use the current match result {match_result} as best value.')
+
+                            # The adjusted result may exceed 1.0 or 100%. This is ok as we are maximizing the result.
+                            logger.info(f'use_best_param: {self.use_best_param}, adjusted result: {reported_match_result}')
                         else:
                             reported_match_result = match_result
-                            logger.info(f'There is no best value yet in the trial history. '
-                                        f'Use the current match result {match_result} as best value.')
-
-                        # The adjusted result may exceed 1.0 or 100%. This is ok as we are maximizing the result.
-                        logger.info(f'use_best_param: {use_best_param}, adjusted result: {reported_match_result}')
-                    else:
-                        reported_match_result = match_result
 
-        if pruned_trial:
-            study.tell(trial, state=optuna.trial.TrialState.PRUNED)
-            raise
+            match = {'result': match_result, 'value': reported_match_result, 'pruned': match_pruned,
+                     'failed': pruned_trial, 'opponent': best_trial_num}
+            journal.record('match', **match)
+
+        if match['failed']:
+            # The trial is recorded and the study continues with the next trial.
+            trial.set_user_attr('fail_reason', 'match failed')
+            self.tell(trial, state=optuna.trial.TrialState.PRUNED)
+        elif match['pruned']:
+            # The last reported partial match result is the value of this trial.
+            self.tell(trial, state=optuna.trial.TrialState.PRUNED)
         else:
-            study.tell(trial, reported_match_result)
+            self.tell(trial, self.get_objective(trial, match['value']))
 
-        logger.debug(f'best trial {study.best_trial.number}')
-        logger.debug(f'best value {study.best_value}')
-        logger.debug(f'best param {study.best_params}')
+        self.cleanup_trial()
+
+    def get_objective(self, trial, score):
+        """
+        Returns the value of the trial for the objective of the study. The core hours of a
+        trial are the seconds of position generation and learning times the engine threads.
+        """
+        attrs = trial.user_attrs
+        gen_seconds = sum(attrs.get(f'time_{stage}', 0) for stage in ['train_gen', 'val_gen', 'merge'])
+        core_hours = (gen_seconds * self.gen_threads + attrs.get('time_learn', 0) * self.learn_threads) / 3600
+        trial.set_user_attr('score', score)
+        trial.set_user_attr('core_hours', round(core_hours, 6))
+
+        if self.config.objective == 'elo':
+            # A trial without a match has the elo of the virtual opponent in the fit, 0.
+            elo, error = 0.0, None
+            rating = fit_ratings(self.ledger.entries()).get(self.get_net_digest(trial.number))
+            if rating is not None:
+                elo, error = rating[0], rating[1]
+            trial.set_user_attr('elo', round(elo, 1))
+            trial.set_user_attr('elo_error', None if error is None else round(error, 1))
+            logger.info(f'trial {trial.number} elo: {elo:0.1f} +/- {error or 0:0.1f}')
+            return elo
+        if self.config.objective == 'pareto':
+            return [score, core_hours]
+        if self.config.objective == 'score_per_hour':
+            # At least a core second so that a trial with cached positions is not infinite.
+            return score / max(core_hours, 1 / 3600)
+        return score
+
+    def cleanup_trial(self):
+        """
+        Deletes the eval save folder and applies the retention policy after a trial is told.
+        """
+        best_trial = get_best_trial(self.study)
+        if best_trial is not None:
+            logger.debug(f'best trial {best_trial.number}')
+            logger.debug(f'best value {best_trial.values}')
+            logger.debug(f'best param {best_trial.params}')
+        else:
+            logger.debug('there is no completed trial yet')
 
         # Cleanup eval save folder.
         try:
-            delete_folder(eval_save_folder)
+            delete_folder(self.eval_save_folder)
         except PermissionError:
             # We delete this file later before we enter learning next time.
             logger.debug(f'PermissionError, we delete this file later before learning.')
@@ -1205,56 +2985,784 @@ def main():
             logger.exception(f'Unexpected error in deleting eval save folder as {err}')
             raise
 
-        # Build pandas dataframe, and save to csv file.
-        if is_panda_ok:
-            df = study.trials_dataframe(attrs=('number', 'value', 'params', 'state'))
-            logger.info(f'{df.to_string(index=False)}\n')
-            df.to_csv(f'{sub_study_folder}/{study_name}.csv', index=False)
-        else:
-            for n in study.trials:
-                logger.info(f'trial: {n.number}, params: {n.params}, objective value: {n.value}')
+        try:
+            self.retention.apply(self.study)
+        except OSError as err:
+            logger.warning(f'retention is not applied, as {err}')
+
+
+def get_rate(count, seconds):
+    """
+    Returns count per second or None if it is not known.
+    """
+    if not count or seconds <= 0:
+        return None
+    return count / seconds
+
+
+def parse_sfens_per_second(line):
+    """
+    Returns the speed from a progress line of gensfen or learn or None, like
+    PROGRESS (calc_loss): Sun Mar 28 01:20:13 2021, 1000000 sfens, 37313 sfens/second, epoch 1
+    """
+    m = re.search(r'(\d+) sfens/second', line)
+    if m is None:
+        return None
+    return int(m.group(1))
+
+
+class WorkerStatus:
+    """
+    The live status of a worker, the running stages with their trial, start time and
+    progress, the expected seconds of every stage from the earlier trials and the best
+    value. It is written to a json file that the status server of the main process reads.
+    In pipeline mode the generation of the next trial runs at the same time as the
+    learning or the match of the current trial.
+    """
+    WRITE_INTERVAL = 1.0
+
+    def __init__(self, fn, worker_id):
+        self.fn = Path(fn)
+        self.worker_id = worker_id
+        self.n_trials = None
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.history = {}
+        self.trials_done = 0
+        self.best_value = None
+        self.best_trial = None
+        self.running = True
+        self.last_write = 0
+        self.timer = None
+        self.write(force=True)
+
+    def begin(self, trial, stage):
+        with self.lock:
+            self.stages[stage] = {'trial': trial.number, 'start': time.time()}
+        self.write(force=True)
+
+    def progress(self, stage, **values):
+        with self.lock:
+            if stage not in self.stages:
+                return
+            self.stages[stage].update(values)
+        self.write()
+
+    def end(self, stage, seconds):
+        with self.lock:
+            self.stages.pop(stage, None)
+            self.history.setdefault(stage, []).append(seconds)
+        self.write(force=True)
+
+    def abort(self, trial):
+        """
+        Removes the running stages of a failed trial.
+        """
+        with self.lock:
+            for stage in [k for k, v in self.stages.items() if v['trial'] == trial.number]:
+                del self.stages[stage]
+        self.write(force=True)
+
+    def trial_done(self, study):
+        with self.lock:
+            self.trials_done += 1
+            best_trial = get_best_trial(study)
+            if best_trial is not None:
+                self.best_value, self.best_trial = get_strength(best_trial), best_trial.number
+        self.write(force=True)
+
+    def close(self):
+        with self.lock:
+            self.stages.clear()
+            self.running = False
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        self.write(force=True)
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+        self.write(force=True)
+
+    def write(self, force=False):
+        """
+        Writes the status at most once every WRITE_INTERVAL seconds unless force is True.
+        An update that is not written is written by a timer when the interval is over.
+        """
+        with self.lock:
+            now = time.perf_counter()
+            if not force and now - self.last_write < self.WRITE_INTERVAL:
+                if self.timer is None and self.running:
+                    self.timer = threading.Timer(self.WRITE_INTERVAL - (now - self.last_write), self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+            self.last_write = now
+
+            stages = {}
+            for stage, values in self.stages.items():
+                stages[stage] = dict(values)
+                if self.history.get(stage):
+                    stages[stage]['expected'] = sum(self.history[stage]) / len(self.history[stage])
+
+            status = {
+                'worker': self.worker_id,
+                'pid': os.getpid(),
+                'running': self.running,
+                'n_trials': self.n_trials,
+                'trials_done': self.trials_done,
+                'best_value': self.best_value,
+                'best_trial': self.best_trial,
+                'stages': stages,
+                'time': time.time()
+            }
+
+            tmp = self.fn.with_name(f'{self.fn.name}.{os.getpid()}.tmp')
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(status, f)
+                os.replace(tmp, self.fn)
+            except OSError as err:
+                logger.debug(f'status is not written, as {err}')
+
+
+class StageTimer:
+    """
+    Saves the seconds and the throughput of the stages of a trial as user attrs, like
+    time_learn and learn_sfens_per_second, and appends them as a json line to a file.
+    The running stages are also shown in status if it is given.
+    """
+    STAGES = ['train_gen', 'val_gen', 'merge', 'learn', 'plot', 'move', 'match']
+
+    def __init__(self, fn, worker_id, status=None):
+        self.fn = Path(fn)
+        self.worker_id = worker_id
+        self.host = socket.gethostname()
+        self.status = status
+
+    def start(self, trial, stage):
+        """
+        Returns the start time of the stage for record().
+        """
+        if self.status is not None:
+            self.status.begin(trial, stage)
+        return time.perf_counter()
+
+    def record(self, trial, stage, seconds, **info):
+        """
+        info has the throughput and other values of the stage, None values are skipped.
+        """
+        info = {k: round(v, 1) if isinstance(v, float) else v for k, v in info.items() if v is not None}
+
+        # A stage can run several times in a trial like in the fidelity rungs.
+        total = trial.user_attrs.get(f'time_{stage}', 0) + seconds
+        trial.set_user_attr(f'time_{stage}', round(total, 3))
+        for name, value in info.items():
+            trial.set_user_attr(f'{stage}_{name}', value)
+
+        row = {
+            'trial': trial.number,
+            'worker': self.worker_id,
+            'host': self.host,
+            'stage': stage,
+            'seconds': round(seconds, 3),
+            **info,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+        append_line(self.fn, json.dumps(row))
+
+        if self.status is not None:
+            self.status.end(stage, seconds)
+
+        logger.debug(f'trial {trial.number} {stage} (s): {seconds:0.3f} {info}')
+
+
+def get_csv_line(values):
+    """
+    Returns the values as a csv line, values with a comma, a quote or a new line are quoted.
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerow(values)
+    return buffer.getvalue()
+
+
+class TrialLog:
+    """
+    Appends a row for every finished trial to a csv file. The columns are fixed by the
+    params to optimize, if they are different from the header of an existing file, the
+    old file is renamed and a new one is started.
+    """
+    STAGE_TIMES = [f'time_{stage}' for stage in StageTimer.STAGES]
+
+    def __init__(self, fn, param_names):
+        self.fn = Path(fn)
+        self.columns = (['number', 'state', 'value', 'score', 'core_hours', 'datetime_start',
+                         'datetime_complete', 'duration']
+                        + self.STAGE_TIMES + ['host', 'net_file']
+                        + [f'params_{name}' for name in param_names])
+
+    def create(self):
+        """
+        Writes the header if there is no file yet, workers may create it at the same time.
+        """
+        header = get_csv_line(self.columns)
+        if self.fn.is_file():
+            with open(self.fn) as f:
+                if f.readline() == header:
+                    return
+            old = self.fn.with_name(f'{self.fn.stem}_{time.strftime("%Y%m%d_%H%M%S")}{self.fn.suffix}')
+            os.replace(self.fn, old)
+            logger.info(f'the columns of {self.fn.name} are changed, the old file is renamed to {old.name}')
 
-        # Plot optuna visualization features.
         try:
-            # Print plot in png and html every 4 trials.
-            if num_trials >= 2:
-                params_to_plot = get_plot_params(ini_file)
-                logger.debug(f'params to plot: {params_to_plot}')
-
-                # history
-                fig0 = optuna.visualization.plot_optimization_history(study)
-                fig0.update_layout(width=PLOT_WIDTH, height=PLOT_HEIGHT)
-                fig0.update_layout(paper_bgcolor=OPTUNA_PLOT_BACKGROUND)
-
-                # contour
-                fig1 = optuna.visualization.plot_contour(study, params=params_to_plot)
-                fig1.update_layout(width=PLOT_WIDTH, height=PLOT_HEIGHT_CONTOUR)
-                fig1.update_layout(paper_bgcolor=OPTUNA_PLOT_BACKGROUND)
-
-                # slice
-                fig2 = optuna.visualization.plot_slice(study, params=params_to_plot)
-                fig2.update_layout(width=PLOT_WIDTH, height=PLOT_HEIGHT)
-                fig2.update_layout(paper_bgcolor=OPTUNA_PLOT_BACKGROUND)
-
-                # importances
-                fig3 = optuna.visualization.plot_param_importances(study)
-                fig3.update_layout(width=PLOT_WIDTH, height=PLOT_HEIGHT)
-                fig3.update_layout(paper_bgcolor=OPTUNA_PLOT_BACKGROUND)
-
-                # Save to single html.
-                # include_plotlyjs=True, output file is bigger, but internet is not required.
-                # include_plotlyjs='cdn', output file is smaller, but internet is required.
-                include_plotlyjs = True
-                full_html, auto_play = False, False
-                with open(f'{sub_study_folder}/{study_name}_optimizer_plot.html', 'w') as f:
-                    f.write(fig0.to_html(full_html=full_html, include_plotlyjs=include_plotlyjs, auto_play=auto_play))
-                    f.write(fig1.to_html(full_html=full_html, include_plotlyjs=include_plotlyjs, auto_play=auto_play))
-                    f.write(fig2.to_html(full_html=full_html, include_plotlyjs=include_plotlyjs, auto_play=auto_play))
-                    f.write(fig3.to_html(full_html=full_html, include_plotlyjs=include_plotlyjs, auto_play=auto_play))
+            fd = os.open(self.fn, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            return
+        with os.fdopen(fd, 'w') as f:
+            f.write(header)
+
+    def append(self, frozen_trial):
+        t = frozen_trial
+        duration = None
+        if t.datetime_start is not None and t.datetime_complete is not None:
+            duration = round((t.datetime_complete - t.datetime_start).total_seconds(), 3)
+
+        row = {
+            'number': t.number,
+            'state': t.state.name,
+            'value': t.values[0] if t.values else None,
+            'score': t.user_attrs.get('score'),
+            'core_hours': t.user_attrs.get('core_hours'),
+            'datetime_start': t.datetime_start,
+            'datetime_complete': t.datetime_complete,
+            'duration': duration,
+            'host': t.user_attrs.get('host'),
+            'net_file': t.user_attrs.get('net_file')
+        }
+        for name in self.STAGE_TIMES:
+            row[name] = t.user_attrs.get(name)
+        for name, value in t.params.items():
+            row[f'params_{name}'] = value
+
+        values = ['' if row.get(c) is None else row[c] for c in self.columns]
+
+        append_line(self.fn, get_csv_line(values))
+
+        value = t.values if t.values is not None and len(t.values) > 1 else row['value']
+        logger.info(f'trial: {t.number}, state: {t.state.name}, value: {value}, params: {t.params}')
+
+    def export_parquet(self):
+        """
+        Writes the trial log as a parquet file, it needs pandas and pyarrow.
+        """
+        if not is_panda_ok:
+            logger.warning('pandas is not installed, trial log is not exported to parquet')
+            return
+        dst = self.fn.with_suffix('.parquet')
+        try:
+            pd.read_csv(self.fn).to_parquet(dst, index=False)
+        except ImportError as err:
+            logger.warning(f'trial log is not exported to parquet, as {err}')
+            return
+        logger.info(f'trial log is exported to {dst}')
+
+
+def plot_cost_front(trials):
+    """
+    Returns the figure of the match score against the core hours of the completed trials
+    with the pareto front, the trials that no other trial beats in both score and core
+    hours, or None if there are less than 2 trials with core hours.
+    """
+    points = [(t.user_attrs['core_hours'], get_score(t), t.number) for t in trials
+              if t.state == optuna.trial.TrialState.COMPLETE and 'core_hours' in t.user_attrs]
+    if len(points) < 2:
+        return None
+
+    # The cheapest trials first, a trial is on the front if it has a higher score than
+    # all cheaper trials.
+    front, best = [], float('-inf')
+    for point in sorted(points, key=lambda p: (p[0], -p[1])):
+        if point[1] > best:
+            front.append(point)
+            best = point[1]
+
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=[p[0] for p in points], y=[p[1] for p in points], mode='markers', name='trial',
+        text=[f'trial {p[2]}' for p in points], marker=dict(color='#cccccc')))
+    fig.add_trace(go.Scatter(
+        x=[p[0] for p in front], y=[p[1] for p in front], mode='lines+markers', name='pareto front',
+        text=[f'trial {p[2]}' for p in front], line_shape='hv'))
+    fig.update_layout(title='Pareto front of match score and core hours',
+                      xaxis_title='core hours of position generation and learning',
+                      yaxis_title='match score')
+    return fig
+
+
+def plot_elo(ratings):
+    """
+    Returns a figure of the elo of the nets of the match ledger with one standard deviation
+    error bars, or None if no net has played.
+    """
+    points = sorted((r[3], r[0], r[1], r[2]) for r in ratings.values() if r[3] is not None)
+    if not points:
+        return None
+
+    fig = go.Figure(go.Scatter(
+        x=[p[0] for p in points], y=[p[1] for p in points], mode='markers', name='net',
+        error_y=dict(type='data', array=[p[2] for p in points]),
+        text=[f'games {p[3]}' for p in points]))
+    fig.update_layout(title='Elo of the trial nets from all the matches',
+                      xaxis_title='trial', yaxis_title='elo')
+    return fig
+
+
+def write_ratings(fn, ratings):
+    """
+    Writes the ratings sorted by elo as json, the strongest net first.
+    """
+    rows = [{'net': net, 'trial': r[3], 'elo': round(r[0], 1), 'error': round(r[1], 1), 'games': r[2]}
+            for net, r in sorted(ratings.items(), key=lambda x: -x[1][0])]
+    tmp = Path(f'{fn}.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(rows, f, indent=2)
+    os.replace(tmp, fn)
+
+
+def write_plotlyjs(folder):
+    """
+    Writes plotly.min.js once in the folder, the html plots in the folder load it
+    instead of including their own copy.
+    """
+    fn = Path(folder, 'plotly.min.js')
+    if fn.is_file():
+        return
+    tmp = Path(folder, f'plotly.min.js.{os.getpid()}.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(plotly.offline.get_plotlyjs())
+    os.replace(tmp, fn)
+
+
+class StudyReporter:
+    """
+    Writes the optimizer plots of the study. The study is read from the storage, so the
+    report can be written by another process while the trials are running. The plots are
+    only written again when there are new finished trials.
+    """
+    def __init__(self, config, study_name, storage_name, sub_study_folder):
+        self.config = config
+        self.study_name = study_name
+        self.storage_name = storage_name
+        self.sub_study_folder = sub_study_folder
+        self.last_finished = None
 
+    def report(self, force=False):
+        """
+        Returns True if the plots are written.
+        """
+        study = optuna.load_study(study_name=self.study_name, storage=create_storage(self.storage_name))
+        trials = study.get_trials(deepcopy=False)
+        finished = len([t for t in trials if t.state.is_finished()])
+        completed = len([t for t in trials if t.state == optuna.trial.TrialState.COMPLETE])
+
+        if completed < 2 or (finished == self.last_finished and not force):
+            return False
+        self.last_finished = finished
+
+        params_to_plot = self.config.plot_params
+        logger.debug(f'params to plot: {params_to_plot}')
+
+        # A study with the pareto objective is plotted by its match score.
+        target = {}
+        if len(study.directions) > 1:
+            target = {'target': lambda t: t.values[0], 'target_name': 'score'}
+
+        # history
+        fig0 = optuna.visualization.plot_optimization_history(study, **target)
+        fig0.update_layout(width=PLOT_WIDTH, height=PLOT_HEIGHT)
+        fig0.update_layout(paper_bgcolor=OPTUNA_PLOT_BACKGROUND)
+
+        # contour
+        fig1 = optuna.visualization.plot_contour(study, params=params_to_plot, **target)
+        fig1.update_layout(width=PLOT_WIDTH, height=PLOT_HEIGHT_CONTOUR)
+        fig1.update_layout(paper_bgcolor=OPTUNA_PLOT_BACKGROUND)
+
+        # slice
+        fig2 = optuna.visualization.plot_slice(study, params=params_to_plot, **target)
+        fig2.update_layout(width=PLOT_WIDTH, height=PLOT_HEIGHT)
+        fig2.update_layout(paper_bgcolor=OPTUNA_PLOT_BACKGROUND)
+
+        # importances, the other plots are still written if it fails.
+        figs = [fig1, fig2]
+        try:
+            fig3 = optuna.visualization.plot_param_importances(study, **target)
+            fig3.update_layout(width=PLOT_WIDTH, height=PLOT_HEIGHT)
+            fig3.update_layout(paper_bgcolor=OPTUNA_PLOT_BACKGROUND)
+            figs.append(fig3)
+        except Exception as err:
+            logger.debug(f'param importances are not plotted, as {err}')
+
+        # match score against core hours
+        fig4 = plot_cost_front(trials)
+        if fig4 is not None:
+            fig4.update_layout(width=PLOT_WIDTH, height=PLOT_HEIGHT)
+            fig4.update_layout(paper_bgcolor=OPTUNA_PLOT_BACKGROUND)
+            figs.append(fig4)
+
+        # elo of all the nets from the match ledger
+        ratings = fit_ratings(MatchLedger(get_ledger_file(
+            self.config, self.study_name, self.sub_study_folder)).entries())
+        if ratings:
+            write_ratings(Path(self.sub_study_folder, f'{self.study_name}_ratings.json'), ratings)
+        fig5 = plot_elo(ratings)
+        if fig5 is not None:
+            fig5.update_layout(width=PLOT_WIDTH, height=PLOT_HEIGHT)
+            fig5.update_layout(paper_bgcolor=OPTUNA_PLOT_BACKGROUND)
+            figs.append(fig5)
+
+        # Save to single html, plotly.min.js is loaded from the study folder.
+        write_plotlyjs(self.sub_study_folder)
+        full_html, auto_play = False, False
+        fn = Path(self.sub_study_folder, f'{self.study_name}_optimizer_plot.html')
+        tmp = Path(self.sub_study_folder, f'{fn.name}.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f:
+            f.write(fig0.to_html(full_html=full_html, include_plotlyjs='directory', auto_play=auto_play))
+            for fig in figs:
+                f.write(fig.to_html(full_html=full_html, include_plotlyjs=False, auto_play=auto_play))
+        os.replace(tmp, fn)
+
+        logger.debug(f'optimizer plot is written, finished trials: {finished}')
+        return True
+
+
+def write_report(config, study_name, storage_name, sub_study_folder):
+    """
+    Writes the optimizer plots once, returns True if the plots are written.
+    """
+    try:
+        return StudyReporter(config, study_name, storage_name, sub_study_folder).report(force=True)
+    except KeyError:
+        logger.error(f'study {study_name} is not found in {storage_name}')
+    except Exception as err:
+        logger.debug(f'plotting error, as {err}')
+    return False
+
+
+def run_reporter(config, study_name, storage_name, sub_study_folder, stop_event, log_filename=None):
+    """
+    Writes the optimizer plots every report_interval seconds until stop_event is set,
+    this is the target of the reporter process.
+    """
+    if log_filename is not None and not logger.handlers:
+        setup_logger(log_filename, prefix='[report] ')
+
+    reporter = StudyReporter(config, study_name, storage_name, sub_study_folder)
+    while not stop_event.wait(config.report_interval):
+        try:
+            reporter.report()
         except Exception as err:
             logger.debug(f'plotting error, as {err}')
 
+
+class StatusHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET /status returns the status as json and GET /metrics in the prometheus text format.
+    """
+    def do_GET(self):
+        status = self.server.status_server.get_status()
+        if self.path.split('?')[0] in ['/', '/status']:
+            body, content_type = json.dumps(status, indent=2), 'application/json'
+        elif self.path.split('?')[0] == '/metrics':
+            body, content_type = get_metrics(status), 'text/plain; version=0.0.4'
+        else:
+            self.send_error(404)
+            return
+
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(f'status server: {format % args}')
+
+
+class StatusServer:
+    """
+    Serves the status of the running study on localhost, it reads the status files that
+    the workers write. The elapsed and remaining seconds of the stages are computed when
+    the status is requested.
+    """
+    def __init__(self, port, study_name, n_trials, status_files):
+        self.study_name = study_name
+        self.n_trials = n_trials
+        self.status_files = [Path(fn) for fn in status_files]
+        self.start_time = time.time()
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), StatusHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.status_server = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logger.info(f'status server: http://127.0.0.1:{self.httpd.server_address[1]}/status')
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def get_status(self):
+        now = time.time()
+        workers, best_value, best_trial = [], None, None
+        for fn in self.status_files:
+            try:
+                with open(fn) as f:
+                    worker = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            # Status files of an earlier run are not shown.
+            if worker['time'] < self.start_time - 1:
+                continue
+
+            for values in worker['stages'].values():
+                values['elapsed'] = round(now - values['start'], 1)
+                if 'expected' in values:
+                    values['eta'] = round(max(0.0, values['expected'] - values['elapsed']), 1)
+            workers.append(worker)
+
+            if worker['best_value'] is not None and (best_value is None or worker['best_value'] > best_value):
+                best_value, best_trial = worker['best_value'], worker['best_trial']
+
+        return {
+            'study_name': self.study_name,
+            'n_trials': self.n_trials,
+            'trials_done': sum(w['trials_done'] for w in workers),
+            'best_value': best_value,
+            'best_trial': best_trial,
+            'elapsed': round(now - self.start_time, 1),
+            'workers': workers
+        }
+
+
+def get_metrics(status):
+    """
+    Returns the status in the prometheus text format.
+    """
+    study = status['study_name']
+    lines = [
+        '# TYPE mabigat_trials_done gauge',
+        f'mabigat_trials_done{{study="{study}"}} {status["trials_done"]}',
+        '# TYPE mabigat_trials gauge',
+        f'mabigat_trials{{study="{study}"}} {status["n_trials"]}'
+    ]
+    if status['best_value'] is not None:
+        lines += ['# TYPE mabigat_best_value gauge',
+                  f'mabigat_best_value{{study="{study}"}} {status["best_value"]}']
+
+    # One gauge per stage value like elapsed, eta, sfens_per_second, epoch, val_loss,
+    # games and score.
+    samples = {}
+    for worker in status['workers']:
+        for stage, values in worker['stages'].items():
+            labels = f'study="{study}",worker="{worker["worker"]}",stage="{stage}",trial="{values["trial"]}"'
+            for name, value in values.items():
+                if name in ['trial', 'start', 'expected'] or not isinstance(value, (int, float)):
+                    continue
+                if name in ['elapsed', 'eta']:
+                    name += '_seconds'
+                samples.setdefault(name, []).append(f'mabigat_stage_{name}{{{labels}}} {value}')
+
+    for name, values in samples.items():
+        lines.append(f'# TYPE mabigat_stage_{name} gauge')
+        lines += values
+
+    return '\n'.join(lines) + '\n'
+
+
+def run_worker(config, study_name, storage_name, sub_study_folder, cwd,
+               n_trials, worker_id=0, workers=1, log_filename=None, run_start=None):
+    """
+    Runs n_trials trials of the study, this is the target of worker processes.
+    """
+    if log_filename is not None and not logger.handlers:
+        setup_logger(log_filename, prefix=f'[w{worker_id}] ')
+
+    worker = TrialWorker(config, study_name, storage_name, sub_study_folder, cwd,
+                         worker_id=worker_id, workers=workers, run_start=run_start)
+    worker.run(n_trials)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        prog='%s %s' % (__script_name__, __version__),
+        description=f'{__description__}',
+        epilog='%(prog)s')
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'report'],
+                        help='run: optimize, this is the default.\n'
+                             'report: write the optimizer plot of the study and exit, the study\n'
+                             'can be running. Example:\n'
+                             'python mabigat.py report --ini-file ./ini/example.ini')
+    parser.add_argument('--ini-file', required=True,
+                        help='The path/file or file of initialization file. Example:\n'
+                             'python mabigat.py --ini-file ./ini/example.ini')
+
+    args = parser.parse_args()
+
+    # Get ini file
+    ini_file = args.ini_file
+    ini_file_path = Path(ini_file)
+    if not ini_file_path.is_file():
+        raise Exception(f'ini file {ini_file} does not exists, usage: mabigat.py --ini-file <your ini file>')
+
+    # The ini file is read only once, errors are reported before the study is started.
+    try:
+        config = StudyConfig(ini_file, check_files=args.command != 'report')
+    except ValueError as err:
+        print(f'Error in {ini_file}, {err}')
+        sys.exit(1)
+
+    cwd = Path.cwd().as_posix()
+
+    study_name = config.study_name
+
+    study_folder = Path(cwd, 'study')
+    create_folder(study_folder)
+
+    sub_study_folder = Path(study_folder, study_name)
+    create_folder(sub_study_folder)
+
+    log_filename = f'{sub_study_folder}/{study_name}_log.txt'
+
+    # Define logger in detail after we get the study name.
+    setup_logger(log_filename)
+
+    workers = config.workers
+    n_trials = config.num_trials
+
+    # Define storage, sampler and study.
+    storage_name = config.get_storage(sub_study_folder)
+
+    trial_log = TrialLog(f'{sub_study_folder}/{study_name}.csv', config.get_param_names())
+
+    if args.command == 'report':
+        if write_report(config, study_name, storage_name, sub_study_folder):
+            logger.info(f'optimizer plot is written to {sub_study_folder}/{study_name}_optimizer_plot.html')
+        if config.trial_log_parquet and trial_log.fn.is_file():
+            trial_log.export_parquet()
+        return
+    sampler = create_sampler(config.sampler, parallel=workers > 1 or config.pipeline)
+    pruner = config.create_pruner()
+
+    # The study is created here so that the workers will only load it.
+    optuna.create_study(
+        study_name=study_name,
+        storage=create_storage(storage_name),
+        directions=config.get_directions(),
+        load_if_exists=True,
+        sampler=sampler,
+        pruner=pruner
+    )
+
+    # Logging to file and console.
+    logger.info(f'Mabigat {__version__}')
+    logger.info(f'optuna {optuna.__version__}\n')
+
+    logger.info(f'engine   : {config.engine_file}')
+    if workers > 1:
+        logger.info(f'threads  : {split_cores(config.cores, workers)} per worker')
+    else:
+        logger.info(f'threads  : {config.threads}')
+    logger.info(f'hash     : {config.hash_mb}\n')
+
+    logger.info(f'study name        : {study_name}')
+    logger.info(f'storage           : {storage_name}')
+    logger.info(f'host              : {socket.gethostname()}')
+    logger.info(f'sampler/optimizer : {config.sampler}')
+    logger.info(f'pruner            : {type(pruner).__name__}')
+    logger.info(f'objective         : {config.objective}')
+    logger.info(f'number of trials  : {n_trials}')
+    logger.info(f'number of workers : {workers}\n')
+
+    logger.info(f'number of training positions  : {config.numpos_train}')
+
+    if config.numpos_val == 0:
+        logger.info('number of validation positions: for optimization')
+    else:
+        logger.info(f'number of validation positions: {config.numpos_val}')
+
+    logger.info(f'training depth                : {config.train_depth}')
+
+    if config.val_depth == 0:
+        logger.info('validation depth              : for optimization')
+    else:
+        logger.info(f'validation depth              : {config.val_depth}')
+
+    logger.info(f'book                          : {config.book}\n')
+
+    logger.info(f'eval_save_interval  : {config.eval_save_interval}')
+    logger.info(f'loss_output_interval: {config.loss_output_interval}\n')
+
+    # The optimizer plots are written by another process so that trials do not wait for them.
+    ctx = multiprocessing.get_context('spawn')
+    reporter, stop_reporter = None, ctx.Event()
+    if config.report_interval > 0:
+        reporter = ctx.Process(
+            target=run_reporter,
+            args=(config, study_name, storage_name, sub_study_folder, stop_reporter, log_filename),
+            daemon=True
+        )
+        reporter.start()
+
+    # The status of the workers is served on localhost.
+    status_server = None
+    if config.status_port:
+        status_files = [Path(get_worker_folder(sub_study_folder, i, workers), 'status.json')
+                        for i in range(max(1, workers))]
+        try:
+            status_server = StatusServer(config.status_port, study_name, n_trials, status_files)
+            status_server.start()
+        except OSError as err:
+            logger.warning(f'status server is not started, as {err}')
+
+    # Start the optimization.
+    run_start = time.time()
+    if workers <= 1:
+        run_worker(config, study_name, storage_name, sub_study_folder, cwd, n_trials, run_start=run_start)
+    else:
+        # Every worker runs in its own process and gets its share of the trials.
+        procs = []
+        for worker_id in range(workers):
+            worker_trials = n_trials // workers + (1 if worker_id < n_trials % workers else 0)
+            if worker_trials == 0:
+                continue
+            p = ctx.Process(
+                target=run_worker,
+                args=(config, study_name, storage_name, sub_study_folder, cwd,
+                      worker_trials, worker_id, workers, log_filename, run_start)
+            )
+            p.start()
+            procs.append(p)
+
+        for p in procs:
+            p.join()
+
+    if reporter is not None:
+        stop_reporter.set()
+        reporter.join()
+
+    if status_server is not None:
+        status_server.stop()
+
+    write_report(config, study_name, storage_name, sub_study_folder)
+    if config.trial_log_parquet and trial_log.fn.is_file():
+        trial_log.export_parquet()
+
     logger.info('optimization done')
 
 
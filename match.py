@@ -4,14 +4,64 @@
 This is based on clop-cutechess-cli.py from https://github.com/cutechess/cutechess.
 """
 
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, DEVNULL, call
 import sys
+import os
+import signal
+import math
 import logging
 from pathlib import Path
 
 
 games = 2
 
+
+def parse_score(line):
+    """
+    Returns (wins, losses, draws) from the point of view of the first engine, from a line like
+    Score of 1_nn vs 0_nn: 10 - 5 - 3  [0.639] 18
+    """
+    wld = line.split(': ')[1].split('[')[0]
+    wins, losses, draws = [int(n) for n in wld.split(' - ')]
+    return wins, losses, draws
+
+
+def elo_to_score(elo):
+    return 1 / (1 + 10 ** (-elo / 400))
+
+
+def sprt_llr(wins, losses, draws, elo0, elo1):
+    """
+    Returns the log-likelihood ratio of H1: elo = elo1 against H0: elo = elo0 with the
+    normal approximation of the generalized SPRT on the game results.
+    """
+    n = wins + losses + draws
+    if n == 0:
+        return 0.0
+
+    score = (wins + draws / 2) / n
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / n
+    if variance <= 0:
+        return 0.0
+
+    s0, s1 = elo_to_score(elo0), elo_to_score(elo1)
+    return n * (s1 - s0) * (2 * score - s0 - s1) / (2 * variance)
+
+
+def sprt_bounds(alpha, beta):
+    return math.log(beta / (1 - alpha)), math.log((1 - beta) / alpha)
+
+
+def kill_process_tree(process):
+    """
+    Stops cutechess and the engines that it started.
+    """
+    if os.name == 'nt':
+        call(['taskkill', '/F', '/T', '/PID', str(process.pid)], stdout=DEVNULL, stderr=DEVNULL)
+    else:
+        os.killpg(process.pid, signal.SIGTERM)
+
+
 def main(argv=None):
     sub_study_folder = argv[0]
     study_name = argv[1]
@@ -26,6 +76,11 @@ def main(argv=None):
     draw = argv[12]
     resign = argv[13]
 
+    # Optional sequential test, elo0,elo1,alpha,beta
+    sprt = None
+    if len(argv) > 14 and argv[14] != 'None':
+        sprt = [float(n) for n in argv[14].split(',')]
+
     logging.basicConfig(
         filename=f'{sub_study_folder}/cutechess_log.txt',
         filemode='a',
@@ -55,14 +110,27 @@ def main(argv=None):
 
     logging.debug(f'match command line: {command}')
 
-    process = Popen(command, shell = True, stdout = PIPE)
-    output = process.communicate()[0]
-    if process.returncode != 0:
-        sys.stderr.write('failed to execute command: %s\n' % command)
-        return 2
+    if sprt is not None:
+        elo0, elo1, alpha, beta = sprt
+        lower, upper = sprt_bounds(alpha, beta)
+        logging.debug(f'sprt elo0: {elo0}, elo1: {elo1}, alpha: {alpha}, beta: {beta}, bounds: [{lower:0.3f}, {upper:0.3f}]')
 
-    result = ''
-    for line in output.decode("utf-8").splitlines():
+    # The match is in its own process group so that it can be stopped with its engines.
+    process = Popen(command, shell=True, stdout=PIPE, universal_newlines=True,
+                    start_new_session=os.name != 'nt')
+
+    # Mabigat stops the match when the trial is pruned.
+    def stop_match(signum, frame):
+        logging.debug('match is stopped')
+        kill_process_tree(process)
+        sys.exit(1)
+
+    signal.signal(signal.SIGTERM, stop_match)
+
+    result, wins, losses, draws = '', 0, 0, 0
+    stopped = None
+    for eline in iter(process.stdout.readline, ''):
+        line = eline.rstrip()
         logging.debug(line)
         if line.startswith('Finished match'):
             break
@@ -70,7 +138,34 @@ def main(argv=None):
         if line.startswith('Score of'):
             result = line.split(': ')[1]
             result = result.split('[')[1].split(']')[0]
+            wins, losses, draws = parse_score(line)
+
+            # Partial result for the pruner of the optimizer.
+            sys.stdout.write(f'progress {wins + losses + draws} {result}\n')
+            sys.stdout.flush()
+
+            if sprt is not None:
+                llr = sprt_llr(wins, losses, draws, elo0, elo1)
+                if llr >= upper:
+                    stopped = 'H1'
+                elif llr <= lower:
+                    stopped = 'H0'
+
+                if stopped is not None:
+                    logging.debug(f'sprt {stopped} accepted, llr: {llr:0.3f}, games: {wins + losses + draws}')
+                    kill_process_tree(process)
+                    break
+
+    process.stdout.close()
+    process.wait()
+    if (process.returncode != 0 and stopped is None) or result == '':
+        sys.stderr.write('failed to execute command: %s\n' % command)
+        return 2
 
+    sys.stdout.write(f'games {wins + losses + draws}\n')
+    sys.stdout.write(f'wdl {wins} {draws} {losses}\n')
+    if stopped is not None:
+        sys.stdout.write(f'sprt {stopped}\n')
     sys.stdout.write(f'result {result}\n')
 
 